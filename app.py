@@ -1,21 +1,1759 @@
+import time
+# Taken before the other imports so the startup report covers the whole launch
+LAUNCH_TIME = time.perf_counter()
 import sys
 import os
 import io
-import numpy as np
-from PIL import Image
-import pydicom
+import argparse
+import importlib
+import importlib.util
+import ipaddress
+import json
+import gzip
+import queue
+import socket
+import struct
+import threading
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QPushButton, QLabel, QFileDialog, QGridLayout, 
                             QMessageBox, QFrame, QStatusBar, QProgressBar, QSplitter,
                             QDialog, QCheckBox, QComboBox, QSpinBox, QDoubleSpinBox,
                             QGroupBox, QTabWidget, QSlider, QFormLayout)
 from PyQt5.QtGui import QPixmap, QImage, QIcon, QFont
-from PyQt5.QtCore import Qt, QSize, QSettings, QTimer, QBuffer
-import qdarkstyle
+from PyQt5.QtCore import Qt, QSize, QSettings, QTimer, QBuffer, QEvent, pyqtSignal
 from datetime import datetime
-from pydicom.dataset import FileDataset, FileMetaDataset
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+class StartupProfile:
+    """
+    Time the launch of the viewer and the heavy imports deferred out of it.
+
+    Phases are marked from LAUNCH_TIME until the main window handles its first
+    event, and each deferred module records how long its first import took,
+    whichever thread triggered it. Going over BUDGET seconds prints a warning,
+    so startup regressions show up without having to ask for the report.
+    """
+    BUDGET = 1.0
+
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.phases = []
+        self.imports = OrderedDict()
+        self.lock = threading.Lock()
+
+    def mark(self, phase):
+        """Close the current phase under the given name and return the seconds since launch"""
+        now = time.perf_counter()
+        with self.lock:
+            self.phases.append((phase, now - self.last))
+            self.last = now
+        return now - self.start
+
+    def record_import(self, name, seconds):
+        with self.lock:
+            self.imports.setdefault(name, (seconds, threading.current_thread().name))
+
+    def report(self):
+        with self.lock:
+            phases, imports = list(self.phases), list(self.imports.items())
+        lines = [f"Startup phases (budget {self.BUDGET:.2f} s):"]
+        lines += [f"  {phase:<24}{seconds * 1000:8.1f} ms" for phase, seconds in phases]
+        lines.append(f"  {'total':<24}{sum(seconds for _, seconds in phases) * 1000:8.1f} ms")
+        lines.append("Deferred imports (cumulative, first import only):")
+        lines += [f"  {name:<24}{seconds * 1000:8.1f} ms  [{thread}]" for name, (seconds, thread) in imports]
+        return "\n".join(lines)
+
+STARTUP = StartupProfile(LAUNCH_TIME)
+
+def timed_import(name):
+    """Import a module by name, recording the time of its first import in the startup profile"""
+    loaded = name in sys.modules
+    started = time.perf_counter()
+    # Always go through importlib, it waits for a module another thread is still importing
+    module = importlib.import_module(name)
+    if not loaded:
+        STARTUP.record_import(name, time.perf_counter() - started)
+    return module
+
+class LazyModule:
+    """
+    Placeholder for a heavy module, imported on first attribute access.
+
+    The real module then replaces the placeholder in this module's globals under
+    the same alias, so later lookups cost nothing extra.
+    """
+    def __init__(self, name, alias):
+        self.module_name = name
+        self.alias = alias
+
+    def __getattr__(self, attr):
+        module = timed_import(self.module_name)
+        globals()[self.alias] = module
+        return getattr(module, attr)
+
+# None of these are needed to show the main window, they load on first use or
+# from the warm-up thread started once the window is up
+np = LazyModule('numpy', 'np')
+pydicom = LazyModule('pydicom', 'pydicom')
+Image = LazyModule('PIL.Image', 'Image')
+
+# Imported in the background after the window shows, in dependency order, so the
+# first processed frame does not stall on scipy. Missing optional modules are skipped.
+WARM_UP_MODULES = ('numpy', 'pydicom', 'PIL.Image', 'scipy.ndimage', 'skimage.restoration')
+
+def warm_up_imports(names, report=False):
+    """Import the given modules, skipping missing ones, then print the startup report if asked"""
+    for name in names:
+        try:
+            module = timed_import(name)
+        except ImportError:
+            continue
+        for alias, value in list(globals().items()):
+            if isinstance(value, LazyModule) and value.module_name == name:
+                globals()[alias] = module
+    if report:
+        print(STARTUP.report(), file=sys.stderr)
+
+# Display sizes offered in the settings dialog, each one is a level of the display pyramid
+DISPLAY_SIZES = ["400x400", "512x512", "600x600", "800x800"]
+
+def decode_with_pydicom(path):
+    """Decode the pixels of a file with pydicom and whichever image handlers are installed"""
+    return pydicom.dcmread(path).pixel_array
+
+def encode_and_save(ds, filepath, transfer_syntax):
+    """Compress a dataset to the given transfer syntax, if any, and write it out"""
+    if transfer_syntax is not None:
+        ds.compress(transfer_syntax)
+    ds.save_as(filepath, write_like_original=False)
+    return filepath
+
+def start_process_pool(workers):
+    """
+    Start a process pool whose workers are spawned rather than forked, a fork
+    taken while another thread holds a lock (the import lock during warm-up,
+    say) would leave the worker deadlocked.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+def file_key(path):
+    """Identity of a file's current contents: absolute path, size and modification time"""
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def read_series_uids(paths):
+    """SeriesInstanceUID of each file, read without the pixel data"""
+    return [pydicom.dcmread(path, stop_before_pixels=True, specific_tags=['SeriesInstanceUID'])
+            .get('SeriesInstanceUID') for path in paths]
+
+class DicomPixelReader:
+    """
+    Read DICOM pixel data, mapping uncompressed PixelData straight from the file.
+
+    The PixelData offset is located once per series layout (files of one folder
+    with the same size) and only checked against each further file with two
+    short reads, of the PixelData element header and of the pixel format
+    elements, so a slice costs one page cache mapping instead of a full parse
+    plus a copy of the PixelData bytes. Compressed or unusual data goes through the decoder
+    registered for its transfer syntax (pydicom by default), and series are
+    decoded in parallel worker processes. The most recently used layouts are
+    kept, up to layout_cache_limit of them.
+    """
+    # pydicom.uid.ImplicitVRLittleEndian and ExplicitVRLittleEndian, spelled out so
+    # defining the class does not import pydicom
+    UNCOMPRESSED = ('1.2.840.10008.1.2', '1.2.840.10008.1.2.1')
+    # Fewer compressed files than this are decoded here, a worker costs more to start than they take
+    POOL_MIN_FILES = 8
+    PIXEL_DATA_TAG = b'\xe0\x7f\x10\x00'
+    # Files sharing a layout must store the same values here, not only have the same size
+    FORMAT_TAGS = ('Rows', 'Columns', 'BitsAllocated', 'BitsStored', 'PixelRepresentation',
+                   'SamplesPerPixel', 'NumberOfFrames')
+
+    def __init__(self, workers=None, layout_cache_limit=64):
+        self.layouts = OrderedDict()
+        self.layout_cache_limit = layout_cache_limit
+        self.lock = threading.Lock()
+        self.decoders = {}
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+
+    def register_decoder(self, transfer_syntaxes, decoder):
+        """
+        Use decoder(path) -> ndarray for files in the given transfer syntaxes.
+
+        Decoders run in worker processes when a series is read, so they must be
+        module level functions that can be pickled.
+        """
+        for transfer_syntax in transfer_syntaxes:
+            self.decoders[transfer_syntax] = decoder
+
+    def get_decoder(self, path, transfer_syntax=None):
+        if transfer_syntax is None:
+            transfer_syntax = pydicom.filereader.read_file_meta_info(path).get('TransferSyntaxUID')
+        return self.decoders.get(transfer_syntax, decode_with_pydicom)
+
+    def get_layout(self, path):
+        """
+        Return the PixelData layout of a file, None when it must be decoded, and
+        its transfer syntax when the header had to be read to find out (else None).
+        """
+        layout_key = (os.path.dirname(path), os.path.getsize(path))
+        with self.lock:
+            layout = self.layouts.get(layout_key, False)
+            if layout is not False:
+                self.layouts.move_to_end(layout_key)
+        if layout is None or (layout is not False and self.check_layout(path, layout)):
+            return layout, None
+
+        layout, transfer_syntax = self.find_layout(path)
+        # Compressed files rarely share a size, so they are not worth a cache entry
+        if layout is not None or transfer_syntax in self.UNCOMPRESSED:
+            with self.lock:
+                self.layouts[layout_key] = layout
+                self.layouts.move_to_end(layout_key)
+                while len(self.layouts) > self.layout_cache_limit:
+                    self.layouts.popitem(last=False)
+        return layout, transfer_syntax
+
+    def read(self, path):
+        """Return the pixels of a file, as a read-only memmap view when they are stored uncompressed"""
+        layout, transfer_syntax = self.get_layout(path)
+        if layout is None:
+            return self.get_decoder(path, transfer_syntax)(path)
+        return self.map_pixels(path, layout)
+
+    def read_series(self, paths):
+        """
+        Return the pixels of several files in order.
+
+        Uncompressed files are mapped in this process, compressed ones are
+        decoded in parallel across worker processes.
+        """
+        pixels = [None] * len(paths)
+        pending = []
+        for i, path in enumerate(paths):
+            layout, transfer_syntax = self.get_layout(path)
+            if layout is None:
+                pending.append((i, path, self.get_decoder(path, transfer_syntax)))
+            else:
+                pixels[i] = self.map_pixels(path, layout)
+
+        if len(pending) >= self.POOL_MIN_FILES and self.workers > 1:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = start_process_pool(self.workers)
+            futures = [(i, self.pool.submit(decoder, path)) for i, path, decoder in pending]
+            for i, future in futures:
+                pixels[i] = future.result()
+        else:
+            for i, path, decoder in pending:
+                pixels[i] = decoder(path)
+        return pixels
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def map_pixels(self, path, layout):
+        offset, dtype, shape, mask, _, _ = layout
+        pixels = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+        if mask is not None:
+            # pydicom clears the unused high bits of unsigned data, do the same
+            pixels = np.bitwise_and(pixels, mask)
+        return pixels
+
+    def check_layout(self, path, layout):
+        """Confirm the file has the expected PixelData header and pixel format values at the cached offsets"""
+        offset, _, _, _, header, format_values = layout
+        start = format_values[0][0]
+        end = max(position + len(value) for position, value in format_values)
+        with open(path, 'rb') as f:
+            f.seek(offset - len(header))
+            if f.read(len(header)) != header:
+                return False
+            f.seek(start)
+            block = f.read(end - start)
+        return all(block[position - start:position - start + len(value)] == value
+                   for position, value in format_values)
+
+    def find_layout(self, path):
+        """
+        Locate the PixelData of a file, returning the layout (None when it cannot
+        be mapped directly) and the transfer syntax read from the header.
+        """
+        ds = pydicom.dcmread(path, stop_before_pixels=True)
+        transfer_syntax = ds.file_meta.get('TransferSyntaxUID') if hasattr(ds, 'file_meta') else None
+        if transfer_syntax not in self.UNCOMPRESSED:
+            return None, transfer_syntax
+        # Where this file stores the format values, taken before reading them converts the raw elements
+        format_elements = [ds.get_item(keyword) for keyword in self.FORMAT_TAGS if keyword in ds]
+
+        bits_allocated = ds.get('BitsAllocated')
+        bits_stored = ds.get('BitsStored', bits_allocated)
+        signed = ds.get('PixelRepresentation', 0) == 1
+        frames = int(ds.get('NumberOfFrames', 1) or 1)
+        if (bits_allocated not in (8, 16, 32) or ds.get('SamplesPerPixel', 1) != 1
+                or (signed and bits_stored != bits_allocated)):
+            return None, transfer_syntax
+
+        shape = (ds.Rows, ds.Columns) if frames == 1 else (frames, ds.Rows, ds.Columns)
+        dtype = np.dtype(f"<{'i' if signed else 'u'}{bits_allocated // 8}")
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        length = struct.pack('<I', nbytes)
+
+        if transfer_syntax == pydicom.uid.ExplicitVRLittleEndian:
+            candidates = [self.PIXEL_DATA_TAG + vr + b'\x00\x00' + length for vr in (b'OW', b'OB')]
+        else:
+            candidates = [self.PIXEL_DATA_TAG + length]
+
+        # PixelData is the last top-level element apart from optional trailing padding
+        with open(path, 'rb') as f:
+            data = f.read()
+        for header in candidates:
+            position = data.rfind(header)
+            if position >= 0 and position + len(header) + nbytes <= len(data):
+                mask = (1 << bits_stored) - 1 if bits_stored < bits_allocated else None
+                format_values = tuple(sorted((raw.value_tell, data[raw.value_tell:raw.value_tell + raw.length])
+                                             for raw in format_elements))
+                return (position + len(header), dtype, shape, mask, header, format_values), transfer_syntax
+        return None, transfer_syntax
+
+
+class DicomWriter:
+    """
+    Write DICOM datasets, optionally compressed, encoding files in parallel worker processes.
+
+    RLE Lossless is always available through pydicom, other transfer syntaxes
+    can be used when pydicom has an encoder plugin installed for them.
+    """
+    # Transfer syntax UIDs as in pydicom.uid, spelled out so defining the class does not import pydicom
+    COMPRESSIONS = {
+        'RLE Lossless': '1.2.840.10008.1.2.5',
+        'JPEG-LS Lossless': '1.2.840.10008.1.2.4.80',
+        'JPEG 2000 Lossless': '1.2.840.10008.1.2.4.90',
+    }
+    # Smaller batches, such as the four images of an export, are encoded here
+    POOL_MIN_FILES = 8
+
+    @classmethod
+    def available_compressions(cls):
+        """Names of the compression schemes the installed pydicom can encode"""
+        try:
+            from pydicom.pixels import get_encoder
+        except ImportError:
+            # pydicom 2.x
+            from pydicom.encoders import get_encoder
+        return [name for name, transfer_syntax in cls.COMPRESSIONS.items()
+                if get_encoder(transfer_syntax).is_available]
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def derived_dataset(self, source_path, pixels, suffix):
+        """
+        Build a dataset for a processed [0, 1] image, keeping the headers of its source slice.
+
+        Pixels are stored as 12-bit unsigned data, and all images derived with the
+        same suffix from one source series share a new SeriesInstanceUID.
+        """
+        ds = pydicom.dcmread(source_path, stop_before_pixels=True)
+        ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        ds.SeriesInstanceUID = pydicom.uid.generate_uid(entropy_srcs=[str(ds.get('SeriesInstanceUID', source_path)), suffix])
+        ds.SOPInstanceUID = pydicom.uid.generate_uid()
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.SeriesDescription = f"{ds.get('SeriesDescription') or 'Dixon'}_{suffix}"
+
+        for keyword in ('RescaleSlope', 'RescaleIntercept', 'RescaleType', 'WindowCenter', 'WindowWidth'):
+            if keyword in ds:
+                delattr(ds, keyword)
+
+        ds.Rows, ds.Columns = pixels.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        ds.PixelData = np.round(np.clip(pixels, 0, 1) * 4095).astype('<u2').tobytes()
+        ds['PixelData'].VR = 'OW'
+        return ds
+
+    def write_series(self, datasets, filepaths, compression=None):
+        """Save each dataset to its path, compressed with the named scheme when given"""
+        transfer_syntax = self.COMPRESSIONS[compression] if compression else None
+        if transfer_syntax is None or len(datasets) < self.POOL_MIN_FILES or self.workers < 2:
+            return [encode_and_save(ds, filepath, transfer_syntax)
+                    for ds, filepath in zip(datasets, filepaths)]
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = start_process_pool(self.workers)
+        futures = [self.pool.submit(encode_and_save, ds, filepath, transfer_syntax)
+                   for ds, filepath in zip(datasets, filepaths)]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+class VolumeWriter:
+    """
+    Stream named (N, H, W) float32 volumes to NIfTI or HDF5, one slice at a time.
+
+    NIfTI writes one <prefix>_<name>.nii.gz per volume, gzip-compressed as the
+    slices arrive; HDF5 writes <prefix>.h5 with one dataset per volume, chunked
+    by slice and gzip-compressed, and needs h5py. Slices only have to be held
+    until write_slice returns, so no full float volume is kept in memory.
+
+    The affine maps (column, row, slice) voxel indices to RAS millimetres, as
+    NIfTI expects; HDF5 datasets are stored (slice, row, column) and carry the
+    affine and their (slice, row, column) spacing as attributes.
+    """
+    FORMATS = {'NIfTI': '.nii', 'HDF5': '.h5'}
+    # NIfTI-1 header, 348 bytes, followed by a 4 byte empty extension block
+    NIFTI_HEADER = struct.Struct('<i10s18sihcb8h3f4h8f3fhcb4f2i80s24s2h6f4f4f4f16s4s')
+
+    def __init__(self, prefix, names, shape, affine, volume_format='NIfTI', compress=True):
+        if volume_format not in self.FORMATS:
+            raise ValueError(f"Unknown volume format: {volume_format}")
+        self.names = list(names)
+        self.shape = tuple(shape)
+        self.affine = np.asarray(affine, dtype=np.float64)
+        self.volume_format = volume_format
+        self.next_slice = 0
+        self.files = {}
+        self.h5 = None
+
+        if volume_format == 'NIfTI':
+            suffix = '.nii.gz' if compress else '.nii'
+            for name in self.names:
+                path = f"{prefix}_{name}{suffix}"
+                handle = gzip.open(path, 'wb', compresslevel=6) if compress else open(path, 'wb')
+                handle.write(self.nifti_header())
+                self.files[name] = handle
+        else:
+            try:
+                import h5py
+            except ImportError:
+                raise ImportError("HDF5 export needs the h5py package (pip install h5py)")
+            self.h5 = h5py.File(prefix + '.h5', 'w')
+            spacing = self.spacing()
+            for name in self.names:
+                dataset = self.h5.create_dataset(
+                    name, shape=self.shape, dtype='float32', chunks=(1,) + self.shape[1:],
+                    compression='gzip' if compress else None, shuffle=compress)
+                dataset.attrs['affine'] = self.affine
+                dataset.attrs['spacing'] = spacing[::-1]
+
+    def spacing(self):
+        """(column, row, slice) voxel size in millimetres, from the affine"""
+        return tuple(float(v) for v in np.linalg.norm(self.affine[:3, :3], axis=0))
+
+    def nifti_header(self):
+        slices, rows, cols = self.shape
+        spacing = self.spacing()
+        header = self.NIFTI_HEADER.pack(
+            348, b'', b'', 0, 0, b'r', 0,
+            3, cols, rows, slices, 1, 1, 1, 1,      # dim
+            0.0, 0.0, 0.0,                          # intent parameters
+            0, 16, 32, 0,                           # intent, float32, bitpix, slice_start
+            1.0, spacing[0], spacing[1], spacing[2], 0.0, 0.0, 0.0, 0.0,
+            352.0, 1.0, 0.0,                        # vox_offset, scl_slope, scl_inter
+            0, b'\0', 2,                           # slice_end, slice_code, millimetres
+            0.0, 0.0, 0.0, 0.0, 0, 0,
+            b'Dixon fat-water separation', b'',
+            0, 1,                                   # qform unset, sform from the scanner
+            0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+            *self.affine[0], *self.affine[1], *self.affine[2],
+            b'', b'n+1\0')
+        return header + b'\0' * 4
+
+    def write_slice(self, planes):
+        """Append the next slice of every volume, planes maps each name to an (H, W) image"""
+        if self.next_slice >= self.shape[0]:
+            raise ValueError("All slices were already written")
+        planes = {name: np.asarray(planes[name], dtype=np.float32) for name in self.names}
+        for name, plane in planes.items():
+            if plane.shape != tuple(self.shape[1:]):
+                raise ValueError(f"{name} slice is {plane.shape}, the volume expects {tuple(self.shape[1:])}")
+        for name, plane in planes.items():
+            if self.h5 is not None:
+                self.h5[name][self.next_slice] = plane
+            else:
+                # NIfTI runs column fastest, then row, then slice: C order of each (H, W) plane
+                self.files[name].write(np.ascontiguousarray(plane, dtype='<f4').tobytes())
+        self.next_slice += 1
+
+    def close(self):
+        for handle in self.files.values():
+            handle.close()
+        self.files = {}
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+
+    @staticmethod
+    def series_affine(headers):
+        """
+        Voxel to RAS affine of slices ordered along their normal, from their
+        ImagePositionPatient, ImageOrientationPatient and PixelSpacing.
+        """
+        first = headers[0]
+        row_spacing, col_spacing = [float(v) for v in first.get('PixelSpacing', [1.0, 1.0])]
+        orientation = np.array(first.get('ImageOrientationPatient', [1, 0, 0, 0, 1, 0]), dtype=np.float64)
+        row_direction, col_direction = orientation[:3], orientation[3:]
+        origin = np.array(first.get('ImagePositionPatient', [0, 0, 0]), dtype=np.float64)
+
+        if len(headers) > 1 and 'ImagePositionPatient' in headers[-1]:
+            last = np.array(headers[-1].ImagePositionPatient, dtype=np.float64)
+            slice_step = (last - origin) / (len(headers) - 1)
+        else:
+            thickness = float(first.get('SpacingBetweenSlices', first.get('SliceThickness', 1.0)))
+            slice_step = np.cross(row_direction, col_direction) * thickness
+        if not np.any(slice_step):
+            slice_step = np.cross(row_direction, col_direction)
+
+        affine = np.eye(4)
+        affine[:3, 0] = row_direction * col_spacing
+        affine[:3, 1] = col_direction * row_spacing
+        affine[:3, 2] = slice_step
+        affine[:3, 3] = origin
+        # DICOM patient coordinates are LPS
+        affine[:2] *= -1
+        return affine
+
+class DixonProcessor:
+    """
+    Two-point Dixon separation engine, independent of the user interface.
+
+    Works on single slices (H, W) or whole stacks (N, H, W), in which case
+    each slice is filtered and normalized on its own and the separation runs
+    as one vectorized pass over the stack.
+    """
+
+    def __init__(self, bias_cache_limit=8, shift_cache_limit=4096):
+        # In-phase/out-phase shifts per slice pair key, estimated once and reused, least recently used first
+        self.shift_cache = OrderedDict()
+        self.shift_cache_limit = shift_cache_limit
+        # Bias fields and fat/water swap maps per series key, least recently used first
+        self.bias_cache = OrderedDict()
+        self.swap_cache = OrderedDict()
+        self.bias_cache_limit = bias_cache_limit
+        self.cache_lock = threading.Lock()
+
+    def separate(self, in_phase, out_phase, fat_threshold=0.1, noise_reduction='None',
+                 registration=False, keys=None, bias_field=None, swap_map=None):
+        """
+        Return the normalized in-phase, out-phase, water and fat images of a slice or stack.
+
+        With registration, out-phase slices are first aligned to their in-phase
+        slices; keys (one per slice, e.g. the file_key of both files) let the
+        estimated shifts be cached and reused. A bias_field of the same shape as
+        the images is divided out of both before normalization, and pixels set in
+        a swap_map (see detect_swaps) are treated as fat-dominant.
+        """
+        in_phase = in_phase.astype(np.float32, copy=False)
+        out_phase = out_phase.astype(np.float32, copy=False)
+
+        if registration:
+            if in_phase.ndim == 2:
+                out_phase = self.align(in_phase[np.newaxis], out_phase[np.newaxis], keys)[0]
+            else:
+                out_phase = self.align(in_phase, out_phase, keys)
+
+        # Keep preprocessing in native scale, noise reduction stays in-plane for stacks
+        if in_phase.ndim == 3 and (noise_reduction != 'None' or bias_field is not None):
+            fields = bias_field if bias_field is not None else [None] * len(in_phase)
+            in_phase = np.stack([self.preprocess_image(s, noise_reduction, True, f)
+                                 for s, f in zip(in_phase, fields)])
+            out_phase = np.stack([self.preprocess_image(s, noise_reduction, True, f)
+                                  for s, f in zip(out_phase, fields)])
+        elif in_phase.ndim == 2:
+            in_phase = self.preprocess_image(in_phase, noise_reduction, True, bias_field)
+            out_phase = self.preprocess_image(out_phase, noise_reduction, True, bias_field)
+
+        # Normalize for Dixon processing while maintaining scale
+        in_phase_norm = self.normalize_image(in_phase)
+        out_phase_norm = self.normalize_image(out_phase)
+
+        # Perform fat-water separation in native scale
+        water, fat = self.perform_fat_water_separation(
+            in_phase_norm,
+            out_phase_norm,
+            fat_threshold=fat_threshold,
+            swap_map=swap_map,
+        )
+
+        return [in_phase_norm, out_phase_norm, water, fat]
+
+    def align(self, in_phase, out_phase, keys=None):
+        """Resample (N, H, W) out-phase slices onto their in-phase slices, caching shifts by key"""
+        shifts = np.zeros((len(in_phase), 2), dtype=np.float64)
+        missing = []
+        with self.cache_lock:
+            for i in range(len(in_phase)):
+                if keys is not None and keys[i] in self.shift_cache:
+                    self.shift_cache.move_to_end(keys[i])
+                    shifts[i] = self.shift_cache[keys[i]]
+                else:
+                    missing.append(i)
+
+        if missing:
+            shifts[missing] = self.estimate_shifts(in_phase[missing], out_phase[missing])
+            if keys is not None:
+                with self.cache_lock:
+                    for i in missing:
+                        self.shift_cache[keys[i]] = tuple(shifts[i])
+                        self.shift_cache.move_to_end(keys[i])
+                    while len(self.shift_cache) > self.shift_cache_limit:
+                        self.shift_cache.popitem(last=False)
+
+        # Slices that are already aligned are left untouched
+        moved = np.abs(shifts).max(axis=1) >= 0.01
+        if not moved.any():
+            return out_phase
+        out_phase = out_phase.copy()
+        out_phase[moved] = self.apply_shifts(out_phase[moved], shifts[moved])
+        return out_phase
+
+    def estimate_shifts(self, reference, moving, levels=2):
+        """
+        Estimate the (dy, dx) shift that aligns each moving slice with its reference slice.
+
+        Phase correlation runs batched over the (N, H, W) stacks. An integer shift
+        is first found on a 2**levels downsampled copy. The central half of each
+        reference slice is then correlated at full resolution with a crop of the
+        moving slice offset by that shift, which leaves a small remainder to find,
+        with a parabolic fit for its subpixel part.
+        """
+        rows, cols = reference.shape[1:]
+        factor = 2 ** levels
+        while factor > 1 and min(rows, cols) // factor < 16:
+            factor //= 2
+
+        # Coarse integer estimate on the downsampled pyramid level
+        coarse = self.correlation_surface(self.downsample(reference, factor), self.downsample(moving, factor))
+        coarse_y, coarse_x = self.surface_peak(coarse)
+        if factor == 1:
+            return self.subpixel_shifts(coarse, coarse_y, coarse_x)
+
+        # Full resolution on a quarter of the pixels, the offsets keep the moving crops inside their slices
+        crop_rows, crop_cols = max(rows // 2, min(rows, 32)), max(cols // 2, min(cols, 32))
+        top, left = (rows - crop_rows) // 2, (cols - crop_cols) // 2
+        offset_y = np.clip(coarse_y * factor, top + crop_rows - rows, top)
+        offset_x = np.clip(coarse_x * factor, left + crop_cols - cols, left)
+        moving_crops = np.stack([image[top - dy:top - dy + crop_rows, left - dx:left - dx + crop_cols]
+                                 for image, dy, dx in zip(moving, offset_y, offset_x)])
+        fine = self.correlation_surface(reference[:, top:top + crop_rows, left:left + crop_cols], moving_crops)
+        shifts = self.subpixel_shifts(fine, *self.surface_peak(fine))
+        shifts[:, 0] += offset_y
+        shifts[:, 1] += offset_x
+        return shifts
+
+    def surface_peak(self, surface):
+        """Integer (dy, dx) of the highest point of each correlation surface, wrapped to signed shifts"""
+        rows, cols = surface.shape[1:]
+        peak = surface.reshape(len(surface), -1).argmax(axis=1)
+        peak_y, peak_x = np.unravel_index(peak, (rows, cols))
+        peak_y = np.where(peak_y > rows // 2, peak_y - rows, peak_y)
+        peak_x = np.where(peak_x > cols // 2, peak_x - cols, peak_x)
+        return peak_y, peak_x
+
+    def subpixel_shifts(self, surface, peak_y, peak_x):
+        """Refine integer surface peaks with a parabolic fit along each axis"""
+        rows, cols = surface.shape[1:]
+        index = np.arange(len(surface))
+        center = surface[index, peak_y % rows, peak_x % cols]
+        shifts = np.zeros((len(surface), 2), dtype=np.float64)
+        for axis, peak_a in enumerate((peak_y, peak_x)):
+            if axis == 0:
+                before = surface[index, (peak_y - 1) % rows, peak_x % cols]
+                after = surface[index, (peak_y + 1) % rows, peak_x % cols]
+            else:
+                before = surface[index, peak_y % rows, (peak_x - 1) % cols]
+                after = surface[index, peak_y % rows, (peak_x + 1) % cols]
+            curvature = before - 2 * center + after
+            subpixel = np.where(curvature < 0, (before - after) / (2 * np.where(curvature < 0, curvature, -1)), 0)
+            shifts[:, axis] = peak_a + np.clip(subpixel, -0.5, 0.5)
+        return shifts
+
+    def correlation_surface(self, reference, moving):
+        """Batched phase correlation of two (N, H, W) stacks, peaking at the shift of moving onto reference"""
+        rows, cols = reference.shape[1:]
+        window = np.outer(np.hanning(rows), np.hanning(cols)).astype(np.float32)
+        reference = (reference - reference.mean(axis=(1, 2), keepdims=True)) * window
+        moving = (moving - moving.mean(axis=(1, 2), keepdims=True)) * window
+        cross = np.fft.rfft2(reference) * np.conj(np.fft.rfft2(moving))
+        cross /= np.abs(cross) + 1e-12
+        return np.fft.irfft2(cross, s=(rows, cols))
+
+    def downsample(self, stack, factor):
+        """Block-average (N, H, W) slices by an integer factor"""
+        if factor == 1:
+            return stack
+        rows, cols = (stack.shape[1] // factor) * factor, (stack.shape[2] // factor) * factor
+        blocks = stack[:, :rows, :cols].reshape(len(stack), rows // factor, factor, cols // factor, factor)
+        return blocks.mean(axis=(2, 4))
+
+    def apply_shifts(self, stack, shifts):
+        """Shift (N, H, W) slices by subpixel (dy, dx) amounts with a Fourier phase ramp"""
+        rows, cols = stack.shape[1:]
+        freq_y = np.fft.fftfreq(rows)[None, :, None]
+        freq_x = np.fft.rfftfreq(cols)[None, None, :]
+        ramp = np.exp(-2j * np.pi * (freq_y * shifts[:, 0, None, None] + freq_x * shifts[:, 1, None, None]))
+        shifted = np.fft.irfft2(np.fft.rfft2(stack) * ramp, s=(rows, cols))
+        # Magnitude images stay non-negative despite the ringing of the resampling
+        return np.maximum(shifted, 0).astype(np.float32)
+
+    def cached_bias_field(self, key):
+        """Bias field previously estimated for a series key, or None"""
+        with self.cache_lock:
+            field = self.bias_cache.get(key)
+            if field is not None:
+                self.bias_cache.move_to_end(key)
+            return field
+
+    def estimate_bias_field(self, volume, key=None, size=32, sigma=(1.0, 0.15)):
+        """
+        Estimate the smooth multiplicative coil shading of an (N, H, W) volume or 2D slice.
+
+        The volume is block-averaged to about size pixels in-plane, and the log
+        intensity of its foreground smoothed with a normalized Gaussian (sigma in
+        slices through-plane, in fractions of the low-resolution width in-plane).
+        The field is scaled to a foreground mean of 1, so dividing by it keeps the
+        native intensity scale, then bilinearly upsampled to full resolution and
+        cached under key.
+        """
+        if key is not None:
+            field = self.cached_bias_field(key)
+            if field is not None and field.shape == volume.shape:
+                return field
+
+        stack = volume[np.newaxis] if volume.ndim == 2 else volume
+        rows, cols = stack.shape[1:]
+        factor = self.bias_factor(rows, cols, size)
+        low_field = self.low_bias_field(self.downsample(stack.astype(np.float32, copy=False), factor), sigma)
+        field = self.upsample_bias_field(low_field, rows, cols, factor)
+        if volume.ndim == 2:
+            field = field[0]
+
+        if key is not None:
+            with self.cache_lock:
+                self.bias_cache[key] = field
+                self.bias_cache.move_to_end(key)
+                while len(self.bias_cache) > self.bias_cache_limit:
+                    self.bias_cache.popitem(last=False)
+        return field
+
+    def bias_factor(self, rows, cols, size=32):
+        """Block size of the low-resolution grid bias fields are estimated on"""
+        return max(1, min(rows, cols) // size)
+
+    def low_bias_field(self, low, sigma=(1.0, 0.15)):
+        """Bias field of a block-averaged (N, h, w) volume, at its low resolution"""
+        # Background noise would drag the field down, only tissue is fitted
+        mask = (low > 0.5 * low.mean()).astype(np.float32)
+        log_low = np.log(np.maximum(low, 1e-6)) * mask
+        sigmas = (sigma[0], sigma[1] * low.shape[1], sigma[1] * low.shape[2])
+        weight = self.smooth(mask, sigmas)
+        log_field = np.where(weight > 1e-3, self.smooth(log_low, sigmas) / np.maximum(weight, 1e-3), 0)
+        if mask.any():
+            log_field = np.where(weight > 1e-3, log_field - log_field[mask > 0].mean(), 0)
+        return np.exp(np.clip(log_field, -1.5, 1.5)).astype(np.float32)
+
+    def upsample_bias_field(self, low_field, rows, cols, factor):
+        """Separable bilinear upsampling of low-resolution fields, (N, h, w) or a single (h, w) slice"""
+        upsample_y = self.interpolation_matrix(low_field.shape[-2], rows, factor)
+        upsample_x = self.interpolation_matrix(low_field.shape[-1], cols, factor)
+        return (upsample_y @ low_field @ upsample_x.T).astype(np.float32, copy=False)
+
+    @staticmethod
+    def swap_detection_available():
+        """Whether scipy, which detect_swaps needs, is installed"""
+        return importlib.util.find_spec('scipy') is not None
+
+    def cached_swaps(self, key):
+        """Swap map and suspicious slices previously detected for a series key, or None"""
+        with self.cache_lock:
+            swaps = self.swap_cache.get(key)
+            if swaps is not None:
+                self.swap_cache.move_to_end(key)
+            return swaps
+
+    def detect_swaps(self, in_phase, out_phase, key=None, series=None, factor=4, boundary=0.4, fat_ratio=1.3):
+        """
+        Find the fat-dominant regions of an (N, H, W) stack that two-point Dixon shows as water.
+
+        series gives one label per slice (e.g. its SeriesInstanceUID) when the
+        stack mixes series. Returns the full-resolution boolean swap map and the
+        indices of slices worth a look. Results are cached under key.
+        """
+        if key is not None:
+            swaps = self.cached_swaps(key)
+            if swaps is not None and swaps[0].shape == in_phase.shape:
+                return swaps
+
+        in_phase = in_phase.astype(np.float32, copy=False)
+        out_phase = out_phase.astype(np.float32, copy=False)
+        rows, cols = in_phase.shape[1:]
+        factor = self.swap_factor(rows, cols, factor)
+        low, border = self.swap_features(in_phase, out_phase, factor, boundary)
+        groups = self.series_groups(series, len(low))
+        low_swap, reference, suspicious = self.decide_swaps(low, border, groups, fat_ratio)
+        swap_map = self.swap_map_slices(low_swap, reference, in_phase, factor, fat_ratio)
+        tissue = low > 0.5 * low.mean(axis=(1, 2), keepdims=True)
+
+        # Through-plane consistency: the swapped share should change smoothly between slices
+        share = swap_map.sum(axis=(1, 2)) / np.maximum(tissue.sum(axis=(1, 2)) * factor * factor, 1)
+        for k in range(len(share)):
+            window = np.arange(max(k - 2, 0), min(k + 3, len(share)))
+            window = window[(window != k) & (groups[window] == groups[k])]
+            if len(window) and abs(share[k] - np.median(share[window])) > 0.1:
+                suspicious.add(k)
+
+        swaps = (swap_map, sorted(suspicious))
+        if key is not None:
+            with self.cache_lock:
+                self.swap_cache[key] = swaps
+                self.swap_cache.move_to_end(key)
+                while len(self.swap_cache) > self.bias_cache_limit:
+                    self.swap_cache.popitem(last=False)
+        return swaps
+
+    def swap_factor(self, rows, cols, factor=4):
+        """Block size of the low-resolution grid fat/water swaps are decided on"""
+        return max(1, min(factor, min(rows, cols) // 16))
+
+    def swap_features(self, in_phase, out_phase, factor, boundary=0.4):
+        """Block-averaged in-phase and border blocks of (N, H, W) slices, all detect_swaps needs at low resolution"""
+        # Out-phase close to zero relative to in-phase (equal fat and water) outlines the
+        # borders between fat- and water-dominant tissue. Borders are thin, a block
+        # holding any border pixel is a border block
+        ratio = (in_phase - out_phase) / np.maximum(in_phase + out_phase, 1e-6)
+        border = self.downsample((ratio > boundary).astype(np.float32), factor) > 0
+        return self.downsample(in_phase, factor), border
+
+    def series_groups(self, series, count):
+        """Index of the series of each slice, all 0 when series is None"""
+        if series is None:
+            return np.zeros(count, dtype=int)
+        return np.unique(np.array([str(uid) for uid in series]), return_inverse=True)[1].ravel()
+
+    def decide_swaps(self, low, border, groups, fat_ratio=1.3):
+        """
+        Decide which blocks of block-averaged slices are fat-dominant.
+
+        Returns the low-resolution swap map, the water reference of each slice and
+        the slices holding a large component close to the decision threshold.
+        """
+        from scipy.ndimage import label, median, distance_transform_edt
+
+        tissue = low > 0.5 * low.mean(axis=(1, 2), keepdims=True)
+        # Each slice is cut along the borders on its own, so a slice without clear
+        # borders cannot merge fat and water across the stack
+        in_plane = np.zeros((3, 3, 3), dtype=bool)
+        in_plane[1] = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
+        labels, count = label(tissue & ~border, structure=in_plane)
+        sizes = np.bincount(labels.ravel(), minlength=count + 1)
+        labels[sizes[labels] < 8] = 0
+        decision = np.zeros(count + 1, dtype=bool)
+        suspicious = set()
+
+        reference = np.full(len(low), np.inf)
+        if labels.any():
+            components = np.arange(1, count + 1)
+            valid = sizes[1:] >= 8
+            component_slice = np.zeros(count, dtype=int)
+            component_slice[labels[labels > 0] - 1] = np.nonzero(labels)[0]
+            medians = np.zeros(count)
+            if valid.any():
+                medians[valid] = median(low, labels, components[valid])
+            # Fat is the brighter tissue in T1-weighted in-phase images: a component is fat-dominant
+            # when its median is fat_ratio times the water reference of its series. The reference
+            # leaves out the components called fat on each pass
+            ratios = np.zeros(count)
+            for step in range(4):
+                water_tissue = (labels > 0) & ~decision[labels]
+                for group in np.unique(groups):
+                    values = low[groups == group][water_tissue[groups == group]]
+                    # Fat can outweigh water in some stacks, the first guess leans to the darker tissue
+                    reference[groups == group] = np.percentile(values, 25 if step == 0 else 50) if len(values) else np.inf
+                ratios = medians / np.maximum(reference[component_slice], 1e-6)
+                decision[1:] = valid & (ratios > fat_ratio)
+
+            # Components near the threshold that cover much of a slice are worth a look
+            tissue_per_slice = np.maximum(tissue.sum(axis=(1, 2)), 1)
+            ambiguous = valid & (np.abs(ratios - fat_ratio) < 0.1)
+            for c in components[ambiguous]:
+                if sizes[c] > 0.05 * tissue_per_slice[component_slice[c - 1]]:
+                    suspicious.add(int(component_slice[c - 1]))
+
+            # Border and small blocks follow their nearest labelled block
+            nearest = distance_transform_edt(labels == 0, return_distances=False, return_indices=True)
+            labels = labels[tuple(nearest)]
+
+        return decision[labels] & tissue, reference, suspicious
+
+    def swap_map_slices(self, low_swap, reference, in_phase, factor, fat_ratio=1.3):
+        """Full-resolution swap map of (N, H, W) slices from their low-resolution decision"""
+        rows, cols = in_phase.shape[1:]
+        swap_map = np.repeat(np.repeat(low_swap, factor, axis=1), factor, axis=2)
+        swap_map = np.pad(swap_map, ((0, 0), (0, rows - swap_map.shape[1]), (0, cols - swap_map.shape[2])),
+                          mode='edge')
+        # At full resolution only pixels brighter than halfway between water and fat are
+        # swapped, which keeps the block edges out of the result
+        return swap_map & (in_phase > (reference * (1 + fat_ratio) / 2)[:, None, None])
+
+    def smooth(self, volume, sigmas):
+        """Gaussian smoothing of a small (N, H, W) volume, one dense kernel matrix per axis"""
+        for axis, sigma in enumerate(sigmas):
+            length = volume.shape[axis]
+            distance = np.arange(length)[:, None] - np.arange(length)[None, :]
+            kernel = np.exp(-0.5 * (distance / max(sigma, 1e-6)) ** 2).astype(np.float32)
+            volume = np.moveaxis(np.tensordot(kernel, volume, axes=(1, axis)), 0, axis)
+        return volume
+
+    def interpolation_matrix(self, low_size, full_size, factor):
+        """(full_size, low_size) linear interpolation weights from block centers to pixel centers"""
+        position = np.clip((np.arange(full_size) + 0.5) / factor - 0.5, 0, low_size - 1)
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, low_size - 1)
+        weight = (position - lower).astype(np.float32)
+        matrix = np.zeros((full_size, low_size), dtype=np.float32)
+        matrix[np.arange(full_size), lower] += 1 - weight
+        matrix[np.arange(full_size), upper] += weight
+        return matrix
+
+    def preprocess_image(self, image, noise_reduction='None', keep_scale=True, bias_field=None):
+        """Preprocess image with optional bias correction and noise reduction, maintaining original scale if requested"""
+
+        # Divide out the coil shading before anything looks at intensities
+        if bias_field is not None:
+            image = image / bias_field
+
+        # Apply noise reduction if specified
+        if noise_reduction == 'Gaussian':
+            from scipy.ndimage import gaussian_filter
+            image = gaussian_filter(image, sigma=1)
+        elif noise_reduction == 'Median':
+            from scipy.ndimage import median_filter
+            image = median_filter(image, size=3)
+        elif noise_reduction == 'Bilateral':
+            from skimage.restoration import denoise_bilateral
+            image = denoise_bilateral(image)
+        
+        if not keep_scale:
+            # Only normalize to 0-255 if specifically requested
+            image = (image - np.min(image)) / (np.max(image) - np.min(image))
+            image = (image * 255).astype(np.uint8)
+        
+        return image
+
+    def normalize_image(self, image):
+        """Normalize the image to the range [0, 1] while preserving relative intensities"""
+        if not isinstance(image, np.ndarray):
+            raise ValueError("Input must be a numpy array")
+        if image.size == 0:
+            raise ValueError("Input array cannot be empty")
+
+        if image.ndim == 3:
+            # Volumes are normalized slice by slice, blank slices are left at zero
+            image_min = image.min(axis=(1, 2), keepdims=True)
+            image_range = image.max(axis=(1, 2), keepdims=True) - image_min
+            image_range[image_range == 0] = 1
+            return (image - image_min) / image_range
+        
+        image_min = np.min(image)
+        image_max = np.max(image)
+        
+        
+        if image_min == image_max:
+            raise ValueError("Input array cannot have all identical values")
+        
+        normalized_image = (image - image_min) / (image_max - image_min)
+        return normalized_image
+
+    def gamma_correction(self, image, gamma=0.8):
+        """Apply gamma correction to the image"""
+        if not isinstance(image, np.ndarray):
+            raise ValueError("Input must be a numpy array")
+        if image.size == 0:
+            raise ValueError("Input array cannot be empty")
+        
+        corrected_image = np.power(image, gamma)
+        return corrected_image
+
+    def native_water_fat(self, in_phase, out_phase, swap_map=None):
+        """
+        Water and fat of native scale in-phase and out-phase images, taken as the
+        larger (IP + OP) / 2 and smaller max(IP - OP, 0) / 2, the other way round
+        in pixels set in swap_map.
+        """
+        in_phase = in_phase.astype(np.float32, copy=False)
+        out_phase = out_phase.astype(np.float32, copy=False)
+        larger = (in_phase + out_phase) / 2.0
+        smaller = np.maximum(in_phase - out_phase, 0) / 2.0
+        if swap_map is None:
+            return larger, smaller
+        return np.where(swap_map, smaller, larger), np.where(swap_map, larger, smaller)
+
+    def fat_fraction(self, in_phase, out_phase, swap_map=None):
+        """
+        Signal fat fraction F / (W + F) of native scale in-phase and out-phase
+        images, with W and F as in native_water_fat. Empty pixels are 0.
+        """
+        water, fat = self.native_water_fat(in_phase, out_phase, swap_map)
+        total = water + fat
+        return np.where(total > 0, fat / np.maximum(total, 1e-6), 0).astype(np.float32)
+
+    def perform_fat_water_separation(self, in_phase, out_phase, fat_threshold=0.1, advanced_method=False,
+                                     swap_map=None):
+        """Perform fat-water separation using basic or advanced Dixon method"""
+        in_phase = in_phase.astype(np.float32)
+        out_phase = out_phase.astype(np.float32)
+
+        # Basic Dixon method with signal difference
+        # Calculate signal difference
+        diff = (in_phase - out_phase)
+        
+        # Calculate masks for fat predominant regions, water image is the mean image
+        mean_signal = (in_phase + out_phase) / 2.0
+        
+        # initialize fat images
+        fat = np.zeros_like(in_phase)
+        # Areas where in_phase > out_phase are fat-containing
+        fat_mask = (in_phase > out_phase) 
+        # Apply masks and enhance contrast
+        fat[fat_mask] = diff[fat_mask]
+
+        # Applying Dixon Equation
+        water = mean_signal
+
+        # Magnitude images cannot tell the larger component apart, in fat-dominant
+        # regions the larger one is fat
+        if swap_map is not None:
+            water = np.where(swap_map, np.maximum(diff, 0) / 2.0, mean_signal)
+            fat = np.where(swap_map, 2.0 * mean_signal, fat)
+        
+        # Normalize while keeping relative intensities
+        water = self.normalize_image(water)
+        fat = self.normalize_image(fat)
+        
+        
+        # Apply threshold to fat image, no need for a threshold on water because there is no subtraction
+        fat[fat < fat_threshold] = 0
+        
+        return water, fat
+
+class WatchFolderIngest:
+    """
+    Headless processing of inphase/outphase series dropped into a watch folder.
+
+    Directories are polled, but only those whose modification time changed are
+    listed again. A file counts as arrived once its size and mtime stayed the
+    same for the settle time. Newly settled slice pairs of a series are separated
+    together in one pass and their water/fat images written by a bounded worker
+    pool; when every slot is taken, ready pairs wait for a later poll.
+
+    Bias fields and swap maps are estimated once over every slice of a series
+    as it stands when its files have settled, and shared by all its batches.
+    They are only estimated again when new slices arrive.
+
+    Only series with newly settled files or pairs left waiting are looked at
+    on a poll. Once every pair of a series is written its files are forgotten;
+    if its folders change later they are listed again, and pairs whose output
+    already exists are skipped.
+    """
+
+    def __init__(self, watch_dir, output_dir, fat_threshold=0.1, noise_reduction='None',
+                 registration=False, bias_correction=False, swap_correction=False, compression=None,
+                 poll_interval=1.0, settle_time=2.0, max_workers=2, max_pending=4, max_batch=16):
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.fat_threshold = fat_threshold
+        self.noise_reduction = noise_reduction
+        self.registration = registration
+        self.bias_correction = bias_correction
+        self.swap_correction = swap_correction
+        self.compression = compression
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.max_batch = max_batch
+
+        self.processor = DixonProcessor()
+        self.pixel_reader = DicomPixelReader()
+        self.dicom_writer = DicomWriter()
+
+        self.dir_mtimes = {}    # directory -> mtime when it was last listed
+        self.unsettled = {}     # file -> ((size, mtime), time that stat was first seen)
+        self.series = {}        # series folder -> {'inphase': [files], 'outphase': [files]}
+        self.arrivals = {}      # file -> time it was first seen
+        self.processed = set()  # (in_phase, out_phase) pairs already written
+        self.in_flight = set()
+        self.waiting = set()    # series folders with settled files or pairs not scheduled yet
+        self.finished = set()   # series folders with a batch done since the last poll
+        self.corrections = {}   # series folder -> corrections shared by its batches, see series_corrections
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.stop_event = threading.Event()
+
+    def run(self):
+        print(f"Watching {self.watch_dir}, writing to {self.output_dir}")
+        self.scan_directory(self.watch_dir)
+        try:
+            while not self.stop_event.is_set():
+                self.poll()
+                self.stop_event.wait(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pixel_reader.close()
+        self.dicom_writer.close()
+
+    def scan_directory(self, path):
+        """List a directory, following new subdirectories and picking up new DICOM files"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            self.dir_mtimes.pop(path, None)
+            return
+        self.dir_mtimes[path] = mtime
+
+        now = time.monotonic()
+        in_series = os.path.basename(path) in ('inphase', 'outphase')
+        for entry in entries:
+            if entry.is_dir():
+                if entry.path not in self.dir_mtimes and os.path.abspath(entry.path) != self.output_dir:
+                    self.scan_directory(entry.path)
+            elif in_series and entry.name.endswith('.dcm') and entry.path not in self.arrivals:
+                self.arrivals[entry.path] = now
+                self.unsettled[entry.path] = None
+
+    def poll(self):
+        """Pick up changed directories, settle new files and schedule the ready slice pairs"""
+        for path, mtime in list(self.dir_mtimes.items()):
+            try:
+                changed = os.stat(path).st_mtime_ns != mtime
+            except FileNotFoundError:
+                del self.dir_mtimes[path]
+                continue
+            if changed:
+                self.scan_directory(path)
+
+        now = time.monotonic()
+        for path, seen in list(self.unsettled.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self.unsettled[path]
+                self.arrivals.pop(path, None)
+                # The rest of its series may have been waiting for it
+                self.waiting.add(os.path.dirname(os.path.dirname(path)))
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if seen is None or seen[0] != signature:
+                self.unsettled[path] = (signature, now)
+            elif now - seen[1] >= self.settle_time:
+                del self.unsettled[path]
+                root, kind = os.path.split(os.path.dirname(path))
+                self.series.setdefault(root, {'inphase': [], 'outphase': []})[kind].append(path)
+                self.waiting.add(root)
+
+        for root in list(self.waiting):
+            if self.schedule(root):
+                self.waiting.discard(root)
+        self.forget_finished()
+
+    def ready_pairs(self, root):
+        """
+        Slice pairs of a series that can be processed now.
+
+        Files are paired in sorted name order, the k-th in-phase with the k-th
+        out-phase file, and only once no file of the series is still settling,
+        so late arrivals cannot shift pairs that were already formed.
+        """
+        prefix = root + os.sep
+        if any(path.startswith(prefix) for path in self.unsettled) or root not in self.series:
+            return []
+
+        files = self.series[root]
+        pairs = []
+        for in_phase, out_phase in zip(sorted(files['inphase']), sorted(files['outphase'])):
+            pair = (in_phase, out_phase)
+            with self.lock:
+                if pair in self.processed or pair in self.in_flight:
+                    continue
+            if all(os.path.exists(path) for path in self.output_paths(root, in_phase)):
+                # Written by an earlier run
+                with self.lock:
+                    self.processed.add(pair)
+                continue
+            pairs.append(pair)
+        return pairs
+
+    def schedule(self, root):
+        """Submit the ready pairs of a series in batches, False when some are left for a later poll"""
+        pairs = self.ready_pairs(root)
+        if not pairs:
+            return True
+        corrections = None
+        if self.bias_correction or self.swap_correction:
+            files = self.series[root]
+            series_pairs = tuple(zip(sorted(files['inphase']), sorted(files['outphase'])))
+            with self.lock:
+                corrections = self.corrections.get(root)
+                if corrections is None or corrections['pairs'] != series_pairs:
+                    # First ready slices of the series, or new ones arrived: estimate again, once
+                    corrections = {'pairs': series_pairs, 'lock': threading.Lock(), 'groups': None}
+                    self.corrections[root] = corrections
+
+        for start in range(0, len(pairs), self.max_batch):
+            # Backpressure: leave the rest for a later poll when all slots are taken
+            if not self.slots.acquire(blocking=False):
+                return False
+            batch = pairs[start:start + self.max_batch]
+            with self.lock:
+                self.in_flight.update(batch)
+            future = self.executor.submit(self.process_batch, root, batch, corrections)
+            future.add_done_callback(lambda f, batch=batch: self.batch_done(f, root, batch))
+        return True
+
+    def batch_done(self, future, root, batch):
+        # Failed pairs are not retried, the error is reported once
+        with self.lock:
+            self.in_flight.difference_update(batch)
+            self.processed.update(batch)
+            corrections = self.corrections.get(root)
+            if corrections is not None and self.processed.issuperset(corrections['pairs']):
+                del self.corrections[root]
+            self.finished.add(root)
+        self.slots.release()
+        if future.exception() is not None:
+            print(f"Error processing {batch[0][0]}: {future.exception()}")
+
+    def forget_finished(self):
+        """Drop the files and pairs of series that have no slice left to process or settle"""
+        with self.lock:
+            finished, self.finished = self.finished, set()
+        for root in finished:
+            files = self.series.get(root)
+            prefix = root + os.sep
+            if files is None or root in self.waiting or any(path.startswith(prefix) for path in self.unsettled):
+                continue
+            pairs = set(zip(sorted(files['inphase']), sorted(files['outphase'])))
+            with self.lock:
+                if not self.processed.issuperset(pairs):
+                    continue
+                self.processed.difference_update(pairs)
+            del self.series[root]
+            for path in files['inphase'] + files['outphase']:
+                self.arrivals.pop(path, None)
+
+    def output_paths(self, root, in_phase):
+        relative = os.path.relpath(root, self.watch_dir)
+        name = os.path.basename(in_phase)
+        return [os.path.join(self.output_dir, relative, kind, name) for kind in ('water', 'fat')]
+
+    def series_corrections(self, corrections, batch):
+        """
+        Bias field and swap map planes of a batch of same-sized slice pairs, and the
+        positions of its slices flagged by the swap detection, None when off.
+
+        The first batch of a series to get here estimates them for all slices of
+        the series, the others wait for it and take their planes.
+        """
+        with corrections['lock']:
+            if corrections['groups'] is None:
+                corrections['groups'] = self.estimate_corrections(corrections['pairs'])
+        group = corrections['groups'][batch[0]]
+        positions = [group['positions'][pair] for pair in batch]
+
+        bias_field = group['bias_field'][positions] if group['bias_field'] is not None else None
+        swap_map = group['swap_map'][positions] if group['swap_map'] is not None else None
+        flagged = [k for k, position in enumerate(positions) if position in group['suspicious']]
+        return bias_field, swap_map, flagged
+
+    def estimate_corrections(self, pairs):
+        """Estimate the corrections of a whole series, per slice size, indexed by slice pair"""
+        in_pixels = self.pixel_reader.read_series([in_phase for in_phase, _ in pairs])
+        out_pixels = self.pixel_reader.read_series([out_phase for _, out_phase in pairs])
+        shapes = OrderedDict()
+        for k, pixels in enumerate(in_pixels):
+            shapes.setdefault(pixels.shape, []).append(k)
+
+        groups = {}
+        for indices in shapes.values():
+            in_stack = np.stack([in_pixels[k] for k in indices]).astype(np.float32)
+            group = {'positions': {pairs[k]: position for position, k in enumerate(indices)},
+                     'bias_field': None, 'swap_map': None, 'suspicious': set()}
+            if self.bias_correction:
+                group['bias_field'] = self.processor.estimate_bias_field(in_stack)
+            if self.swap_correction:
+                out_stack = np.stack([out_pixels[k] for k in indices]).astype(np.float32)
+                series = read_series_uids([pairs[k][0] for k in indices])
+                group['swap_map'], suspicious = self.processor.detect_swaps(in_stack, out_stack, series=series)
+                group['suspicious'] = set(suspicious)
+            for k in indices:
+                groups[pairs[k]] = group
+        return groups
+
+    def process_batch(self, root, pairs, corrections=None):
+        """Separate a batch of slice pairs in one vectorized pass and write their water/fat images"""
+        in_pixels = self.pixel_reader.read_series([in_phase for in_phase, _ in pairs])
+        out_pixels = self.pixel_reader.read_series([out_phase for _, out_phase in pairs])
+
+        # Slices of different sizes are separated in their own stacks
+        groups = OrderedDict()
+        for k, pixels in enumerate(in_pixels):
+            groups.setdefault(pixels.shape, []).append(k)
+
+        datasets, filepaths, suspicious = [], [], []
+        for indices in groups.values():
+            in_stack = np.stack([in_pixels[k] for k in indices]).astype(np.float32)
+            out_stack = np.stack([out_pixels[k] for k in indices]).astype(np.float32)
+            bias_field = swap_map = None
+            if corrections is not None:
+                bias_field, swap_map, flagged = self.series_corrections(corrections, [pairs[k] for k in indices])
+                suspicious.extend(pairs[indices[position]][0] for position in flagged)
+            _, _, water, fat = self.processor.separate(in_stack, out_stack, self.fat_threshold,
+                                                       self.noise_reduction, self.registration,
+                                                       keys=[tuple(map(file_key, pairs[k])) for k in indices],
+                                                       bias_field=bias_field, swap_map=swap_map)
+            for position, k in enumerate(indices):
+                in_phase = pairs[k][0]
+                water_path, fat_path = self.output_paths(root, in_phase)
+                datasets.append(self.dicom_writer.derived_dataset(in_phase, water[position], 'water'))
+                datasets.append(self.dicom_writer.derived_dataset(in_phase, fat[position], 'fat'))
+                filepaths.extend([water_path, fat_path])
+
+        for filepath in filepaths:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self.dicom_writer.write_series(datasets, filepaths, self.compression)
+
+        arrived = min(self.arrivals.get(path, time.monotonic()) for pair in pairs for path in pair)
+        print(f"Processed {len(pairs)} slices of {root} "
+              f"({time.monotonic() - arrived:.1f}s after arrival)")
+        for in_phase in suspicious:
+            print(f"  Possible fat/water swap, check {os.path.relpath(in_phase, self.watch_dir)}")
+
+class SeparationBatcher:
+    """
+    Coalesce concurrent separation jobs into stacked batches.
+
+    Jobs are (N, H, W) stacks. The first queued job opens a batch, which
+    collects further jobs for up to max_wait seconds or max_batch slices.
+    Jobs with the same slice shape and settings are concatenated and go
+    through DixonProcessor.separate together. Slices are normalized one by
+    one, so a job's result does not depend on what it was batched with.
+    """
+
+    def __init__(self, processor, max_batch=32, max_wait=0.005):
+        self.processor = processor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.batched_slices = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, in_phase, out_phase, fat_threshold, noise_reduction, registration=False, keys=None,
+               bias_field=None, swap_map=None):
+        """Queue a stack pair, the future resolves to its in-phase, out-phase, water and fat stacks"""
+        future = Future()
+        self.queue.put({
+            'in_phase': in_phase,
+            'out_phase': out_phase,
+            'settings': (fat_threshold, noise_reduction, registration),
+            'keys': keys,
+            'bias_field': bias_field,
+            'swap_map': swap_map,
+            'future': future,
+        })
+        return future
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            jobs = [job]
+            slices = len(job['in_phase'])
+            deadline = time.monotonic() + self.max_wait
+            while slices < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    job = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.queue.put(None)
+                    break
+                jobs.append(job)
+                slices += len(job['in_phase'])
+            self.run_batch(jobs)
+
+    def run_batch(self, jobs):
+        groups = OrderedDict()
+        for job in jobs:
+            groups.setdefault((job['in_phase'].shape[1:],) + job['settings'], []).append(job)
+
+        for (_, fat_threshold, noise_reduction, registration), group in groups.items():
+            try:
+                in_stack = np.concatenate([job['in_phase'] for job in group])
+                out_stack = np.concatenate([job['out_phase'] for job in group])
+                # Shifts are only cached when every job of the group names its slices
+                keys = None
+                if all(job['keys'] is not None for job in group):
+                    keys = [key for job in group for key in job['keys']]
+                # Each job brings the corrections of its own series, jobs without them are left as is
+                bias_field = swap_map = None
+                if any(job['bias_field'] is not None for job in group):
+                    bias_field = np.concatenate([job['bias_field'] if job['bias_field'] is not None
+                                                 else np.ones_like(job['in_phase']) for job in group])
+                if any(job['swap_map'] is not None for job in group):
+                    swap_map = np.concatenate([job['swap_map'] if job['swap_map'] is not None
+                                               else np.zeros(job['in_phase'].shape, dtype=bool) for job in group])
+                planes = self.processor.separate(in_stack, out_stack, fat_threshold, noise_reduction,
+                                                 registration, keys, bias_field, swap_map)
+            except Exception as e:
+                for job in group:
+                    job['future'].set_exception(e)
+                continue
+
+            self.batches += 1
+            self.batched_slices += len(in_stack)
+            offset = 0
+            for job in group:
+                count = len(job['in_phase'])
+                job['future'].set_result([plane[offset:offset + count] for plane in planes])
+                offset += count
+
+class SeparationRequestHandler(BaseHTTPRequestHandler):
+    """HTTP front end of SeparationServer: GET /stats and POST /separate, see the README"""
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/stats':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        self.send_json(200, self.server.service.get_stats())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/separate':
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        options = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            length = self.headers.get('Content-Length', '0').strip()
+            if not length.isdigit():
+                raise ValueError("Invalid Content-Length")
+            body = self.rfile.read(int(length))
+            content_type, payload = self.server.service.handle_separate(
+                body, self.headers.get('Content-Type', ''), options)
+        except (ValueError, KeyError, FileNotFoundError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_json(self, status, data):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if self.server.service.verbose:
+            super().log_message(format, *args)
+
+class SeparationServer:
+    """
+    Local processing service returning water/fat maps on demand.
+
+    Requests are served on a thread each, their separations coalesced by a
+    SeparationBatcher, and decoded slices are kept in a warm LRU cache keyed by
+    path, size and mtime, so repeated requests for a series skip decoding.
+
+    Clients name files to read and folders to write to, so the server only
+    listens on a loopback address unless allow_remote is set.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8765, fat_threshold=0.1, noise_reduction='None',
+                 registration=False, bias_correction=False, swap_correction=False, compression=None,
+                 cache_limit=512 * 1024 * 1024, verbose=False, allow_remote=False):
+        # An empty host means every interface
+        self.remote = not ipaddress.ip_address(socket.gethostbyname(host or '0.0.0.0')).is_loopback
+        if self.remote and not allow_remote:
+            raise ValueError(f"{host or 'every interface'} is not a loopback address, the server would let "
+                             f"anyone on the network read and write files as this user")
+        self.fat_threshold = fat_threshold
+        self.noise_reduction = noise_reduction
+        self.registration = registration
+        self.bias_correction = bias_correction
+        self.swap_correction = swap_correction
+        self.compression = compression
+        self.verbose = verbose
+
+        self.processor = DixonProcessor()
+        self.pixel_reader = DicomPixelReader()
+        self.dicom_writer = DicomWriter()
+        self.batcher = SeparationBatcher(self.processor)
+
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.cache_limit = cache_limit
+        self.lock = threading.Lock()
+
+        self.started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.slices = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.in_progress = 0
+        self.latencies = deque(maxlen=1000)
+
+        self.httpd = ThreadingHTTPServer((host, port), SeparationRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.service = self
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def serve_forever(self):
+        print(f"Serving on http://{self.address[0]}:{self.address[1]}")
+        if self.remote:
+            print("WARNING: listening beyond this machine. Any client that can reach this port can read "
+                  "any file this user can read and write DICOM files into any folder.", file=sys.stderr)
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+    def close(self):
+        self.httpd.server_close()
+        self.batcher.stop()
+        self.pixel_reader.close()
+        self.dicom_writer.close()
+
+    def load_pixels(self, paths):
+        """Return the float32 pixels of files, from the warm cache when they have not changed"""
+        keys = [file_key(path) for path in paths]
+
+        pixels = [None] * len(paths)
+        missing = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    pixels[i] = self.cache[key]
+                    self.cache_hits += 1
+                else:
+                    missing.append(i)
+                    self.cache_misses += 1
+
+        if missing:
+            decoded = self.pixel_reader.read_series([paths[i] for i in missing])
+            with self.lock:
+                for i, array in zip(missing, decoded):
+                    pixels[i] = np.asarray(array, dtype=np.float32)
+                    if keys[i] not in self.cache:
+                        self.cache[keys[i]] = pixels[i]
+                        self.cache_bytes += pixels[i].nbytes
+                while self.cache_bytes > self.cache_limit and self.cache:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.cache_bytes -= evicted.nbytes
+        return pixels
+
+    def flag(self, value):
+        """Boolean request option, given as a JSON bool or a query string"""
+        if isinstance(value, str):
+            return value.lower() in ('1', 'true', 'yes')
+        return bool(value)
+
+    def series_pairs(self, folder):
+        """Pair the files of a series folder in sorted name order"""
+        in_folder = os.path.join(folder, 'inphase')
+        out_folder = os.path.join(folder, 'outphase')
+        if not (os.path.isdir(in_folder) and os.path.isdir(out_folder)):
+            raise FileNotFoundError(f"No inphase/outphase folders in {folder}")
+        in_files = sorted(f for f in os.listdir(in_folder) if f.endswith('.dcm'))
+        out_files = sorted(f for f in os.listdir(out_folder) if f.endswith('.dcm'))
+        return [(os.path.join(in_folder, in_file), os.path.join(out_folder, out_file))
+                for in_file, out_file in zip(in_files, out_files)]
+
+    def handle_separate(self, body, content_type, options):
+        """Run one /separate request, returning the response content type and body"""
+        started = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            self.in_progress += 1
+        try:
+            result = self.separate(body, content_type, options)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.in_progress -= 1
+        with self.lock:
+            self.latencies.append(time.monotonic() - started)
+        return result
+
+    def separate(self, body, content_type, options):
+        pairs = None
+        if content_type.startswith('application/json'):
+            request = json.loads(body.decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError("The JSON body must be an object")
+            options = dict(options, **request)
+            for name in ('series', 'in_phase', 'out_phase', 'output'):
+                if name in options and not isinstance(options[name], str):
+                    raise ValueError(f"{name} must be a path")
+            if 'series' in options:
+                pairs = self.series_pairs(options['series'])
+            else:
+                pairs = [(options['in_phase'], options['out_phase'])]
+            if not pairs:
+                raise ValueError("No slice pairs to process")
+            in_pixels = self.load_pixels([in_phase for in_phase, _ in pairs])
+            out_pixels = self.load_pixels([out_phase for _, out_phase in pairs])
+            if len({pixels.shape for pixels in in_pixels + out_pixels}) != 1:
+                raise ValueError("All slices must have the same size")
+            in_stack, out_stack = np.stack(in_pixels), np.stack(out_pixels)
+        else:
+            arrays = np.load(io.BytesIO(body), allow_pickle=False)
+            if not isinstance(arrays, np.lib.npyio.NpzFile):
+                raise ValueError("The body must be an .npz archive with in_phase and out_phase arrays")
+            with arrays:
+                in_stack = arrays['in_phase'].astype(np.float32)
+                out_stack = arrays['out_phase'].astype(np.float32)
+            if in_stack.ndim == 2:
+                in_stack, out_stack = in_stack[np.newaxis], out_stack[np.newaxis]
+            if in_stack.ndim != 3 or in_stack.shape != out_stack.shape:
+                raise ValueError("in_phase and out_phase must be matching 2D or 3D arrays")
+
+        fat_threshold = float(options.get('fat_threshold', self.fat_threshold))
+        noise_reduction = options.get('noise_reduction', self.noise_reduction)
+        registration = self.flag(options.get('registration', self.registration))
+        keys = [tuple(map(file_key, pair)) for pair in pairs] if pairs is not None else None
+
+        # Corrections are estimated on the request's own stack, cached per set of files as they are now
+        series_key = tuple(keys) if keys is not None else None
+        bias_field = swap_map = None
+        suspicious = []
+        if self.flag(options.get('bias_correction', self.bias_correction)):
+            bias_field = self.processor.estimate_bias_field(in_stack, key=series_key)
+        if self.flag(options.get('swap_correction', self.swap_correction)):
+            if not DixonProcessor.swap_detection_available():
+                raise ValueError("swap_correction needs scipy, which is not installed")
+            series = read_series_uids([in_phase for in_phase, _ in pairs]) if pairs is not None else None
+            swap_map, suspicious = self.processor.detect_swaps(in_stack, out_stack, key=series_key, series=series)
+
+        _, _, water, fat = self.batcher.submit(in_stack, out_stack, fat_threshold, noise_reduction,
+                                               registration, keys, bias_field, swap_map).result()
+        with self.lock:
+            self.slices += len(in_stack)
+
+        if options.get('output') and pairs is not None:
+            datasets, filepaths = [], []
+            for k, (in_phase, _) in enumerate(pairs):
+                for kind, plane in (('water', water[k]), ('fat', fat[k])):
+                    filepath = os.path.join(options['output'], kind, os.path.basename(in_phase))
+                    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                    datasets.append(self.dicom_writer.derived_dataset(in_phase, plane, kind))
+                    filepaths.append(filepath)
+            written = self.dicom_writer.write_series(datasets, filepaths, self.compression)
+            answer = {'written': written}
+            if swap_map is not None:
+                answer['suspicious_slices'] = [pairs[k][0] for k in suspicious]
+            return 'application/json', json.dumps(answer).encode('utf-8')
+
+        buffer = io.BytesIO()
+        if swap_map is not None:
+            np.savez(buffer, water=water, fat=fat, suspicious_slices=np.array(suspicious, dtype=np.int64))
+        else:
+            np.savez(buffer, water=water, fat=fat)
+        return 'application/octet-stream', buffer.getvalue()
+
+    def get_stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            uptime = time.monotonic() - self.started
+            stats = {
+                'uptime_s': uptime,
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_progress': self.in_progress,
+                'slices': self.slices,
+                'throughput_slices_per_s': self.slices / uptime if uptime > 0 else 0.0,
+                'queue_depth': self.batcher.queue_depth(),
+                'batches': self.batcher.batches,
+                'mean_batch_slices': (self.batcher.batched_slices / self.batcher.batches
+                                      if self.batcher.batches else 0.0),
+                'cache_entries': len(self.cache),
+                'cache_bytes': self.cache_bytes,
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+            }
+        if latencies:
+            stats['latency_mean_s'] = sum(latencies) / len(latencies)
+            stats['latency_p50_s'] = latencies[len(latencies) // 2]
+            stats['latency_p95_s'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return stats
 
 class ImageFrame(QFrame):
+    # Wheel steps, drags and double clicks on the image, forwarded so all panels zoom and pan together
+    zoom_requested = pyqtSignal(int)
+    pan_requested = pyqtSignal(int, int)
+    zoom_reset_requested = pyqtSignal()
+
     def __init__(self, title, parent=None):
         super().__init__(parent)
         self.setFrameStyle(QFrame.StyledPanel | QFrame.Raised)
@@ -47,10 +1785,34 @@ class ImageFrame(QFrame):
         self.image_label.setMinimumSize(400, 400)
         self.image_label.setAlignment(Qt.AlignCenter)
         self.image_label.setStyleSheet("padding: 5px;")
+        self.image_label.installEventFilter(self)
+        self.drag_origin = None
         
         layout.addWidget(self.title_label)
         layout.addWidget(self.image_label)
 
+    def eventFilter(self, obj, event):
+        if obj is self.image_label:
+            if event.type() == QEvent.Wheel:
+                delta = event.angleDelta().y()
+                if delta:
+                    self.zoom_requested.emit(1 if delta > 0 else -1)
+                return True
+            if event.type() == QEvent.MouseButtonDblClick:
+                self.zoom_reset_requested.emit()
+                return True
+            if event.type() == QEvent.MouseButtonPress and event.button() == Qt.LeftButton:
+                self.drag_origin = event.pos()
+                return True
+            if event.type() == QEvent.MouseMove and self.drag_origin is not None:
+                delta = event.pos() - self.drag_origin
+                self.drag_origin = event.pos()
+                self.pan_requested.emit(delta.x(), delta.y())
+                return True
+            if event.type() == QEvent.MouseButtonRelease:
+                self.drag_origin = None
+        return super().eventFilter(obj, event)
+
 class SettingsDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -60,11 +1822,21 @@ class SettingsDialog(QDialog):
         # Initialize settings
         self.settings = QSettings('MRIViewer', 'DixonProcessor')
         
-        # Create tabs
+        # Create tabs, each one is built and loaded the first time it is shown
+        self.tab_pages = [
+            ("Display", self.create_display_tab, self.load_display_settings, self.save_display_settings),
+            ("Processing", self.create_processing_tab, self.load_processing_settings, self.save_processing_settings),
+            ("Export", self.create_export_tab, self.load_export_settings, self.save_export_settings),
+        ]
+        self.built_tabs = set()
         tabs = QTabWidget()
-        tabs.addTab(self.create_display_tab(), "Display")
-        tabs.addTab(self.create_processing_tab(), "Processing")
-        tabs.addTab(self.create_export_tab(), "Export")
+        for name, *_ in self.tab_pages:
+            page = QWidget()
+            page_layout = QVBoxLayout(page)
+            page_layout.setContentsMargins(0, 0, 0, 0)
+            tabs.addTab(page, name)
+        self.tabs = tabs
+        tabs.currentChanged.connect(self.build_tab)
         
         # Dialog buttons
         buttons_layout = QHBoxLayout()
@@ -88,8 +1860,17 @@ class SettingsDialog(QDialog):
         cancel_button.clicked.connect(self.reject)
         apply_button.clicked.connect(self.apply_settings)
         
-        # Load saved settings
-        self.load_settings()
+        # Only the tab shown first is needed to open the dialog
+        self.build_tab(tabs.currentIndex())
+
+    def build_tab(self, index):
+        """Build the contents of a tab the first time it is shown and load its saved settings"""
+        if index < 0 or index in self.built_tabs:
+            return
+        _, create, load, _ = self.tab_pages[index]
+        self.tabs.widget(index).layout().addWidget(create())
+        self.built_tabs.add(index)
+        load()
 
     def create_display_tab(self):
         tab = QWidget()
@@ -100,7 +1881,7 @@ class SettingsDialog(QDialog):
         display_layout = QFormLayout()
         
         self.window_size = QComboBox()
-        self.window_size.addItems(["400x400", "512x512", "600x600", "800x800"])
+        self.window_size.addItems(DISPLAY_SIZES)
         
         self.play_speed = QComboBox()
         self.play_speed.addItems(["0.25x", "0.5x", "1x", "1.5x", "2x", "4x"])
@@ -202,9 +1983,24 @@ class SettingsDialog(QDialog):
         self.noise_reduction.addItems(["None", "Gaussian", "Median", "Bilateral"])
         
         self.advanced_dixon = QCheckBox("Use Advanced Dixon Method")
+
+        self.registration = QCheckBox("Correct Misregistration")
+        self.registration.setToolTip("Align out-phase to in-phase slices before separation")
         
         dixon_layout.addRow("Fat Threshold:", self.fat_threshold)
         dixon_layout.addRow("Noise Reduction:", self.noise_reduction)
+        self.bias_correction = QCheckBox("Correct Intensity Inhomogeneity")
+        self.bias_correction.setToolTip("Remove smooth coil shading, estimated once per series")
+
+        self.swap_correction = QCheckBox("Correct Fat/Water Swaps")
+        self.swap_correction.setToolTip("Detect fat-dominant regions shown as water and swap them back")
+        if not DixonProcessor.swap_detection_available():
+            self.swap_correction.setEnabled(False)
+            self.swap_correction.setToolTip("Needs scipy, which is not installed")
+
+        dixon_layout.addRow(self.registration)
+        dixon_layout.addRow(self.bias_correction)
+        dixon_layout.addRow(self.swap_correction)
         dixon_group.setLayout(dixon_layout)
            
         
@@ -222,9 +2018,13 @@ class SettingsDialog(QDialog):
         export_layout = QFormLayout()
         
         self.export_format = QComboBox()
-        self.export_format.addItems(["DICOM", "PNG", "JPEG", "TIFF", "GIF"])
+        self.export_format.addItems(["DICOM", "PNG", "JPEG", "TIFF", "GIF"] + list(VolumeWriter.FORMATS))
         
         self.compression = QCheckBox("Use Compression")
+
+        self.dicom_compression = QComboBox()
+        self.dicom_compression.addItems(DicomWriter.available_compressions())
+        self.dicom_compression.setToolTip("Lossless transfer syntax used for compressed DICOM export")
         
         # Add GIF settings
         self.gif_settings = QGroupBox("GIF Settings")
@@ -245,6 +2045,7 @@ class SettingsDialog(QDialog):
         
         export_layout.addRow("Export Format:", self.export_format)
         export_layout.addRow("Compression:", self.compression)
+        export_layout.addRow("DICOM Compression:", self.dicom_compression)
         export_layout.addWidget(self.gif_settings)
         export_group.setLayout(export_layout)
         
@@ -254,48 +2055,62 @@ class SettingsDialog(QDialog):
         return tab
 
     def load_settings(self):
-        # Load Display settings
+        for index in sorted(self.built_tabs):
+            self.tab_pages[index][2]()
+
+    def save_settings(self):
+        # Tabs never opened keep their saved values
+        for index in sorted(self.built_tabs):
+            self.tab_pages[index][3]()
+
+    def load_display_settings(self):
         self.window_size.setCurrentText(self.settings.value('display/window_size', '400x400'))
         self.play_speed.setCurrentText(self.settings.value('display/play_speed', '1x'))
         self.auto_window.setChecked(self.settings.value('display/auto_window', True, type=bool))
         self.window_width.setValue(self.settings.value('display/window_width', 2000, type=int))
         self.window_center.setValue(self.settings.value('display/window_center', 0, type=int))
-        
-        # Load Processing settings
-        self.fat_threshold.setValue(self.settings.value('processing/fat_threshold', 0.1, type=float))
-        self.noise_reduction.setCurrentText(self.settings.value('processing/noise_reduction', 'None'))
 
         # Load contrast and brightness settings
         self.contrast_slider.setValue(self.settings.value('display/contrast', 0, type=int))
         self.brightness_slider.setValue(self.settings.value('display/brightness', 0, type=int))
-        
-        
-        # Load Export settings
+
+    def load_processing_settings(self):
+        self.fat_threshold.setValue(self.settings.value('processing/fat_threshold', 0.1, type=float))
+        self.noise_reduction.setCurrentText(self.settings.value('processing/noise_reduction', 'None'))
+        self.registration.setChecked(self.settings.value('processing/registration', False, type=bool))
+        self.bias_correction.setChecked(self.settings.value('processing/bias_correction', False, type=bool))
+        self.swap_correction.setChecked(self.settings.value('processing/swap_correction', False, type=bool)
+                                        and self.swap_correction.isEnabled())
+
+    def load_export_settings(self):
         self.export_format.setCurrentText(self.settings.value('export/format', 'DICOM'))
         self.compression.setChecked(self.settings.value('export/compression', True, type=bool))
+        self.dicom_compression.setCurrentText(self.settings.value('export/dicom_compression', 'RLE Lossless'))
         self.gif_duration.setValue(self.settings.value('export/gif_duration', 500, type=int))
         self.gif_loop.setChecked(self.settings.value('export/gif_loop', True, type=bool))
 
-    def save_settings(self):
-        # Save Display settings
+    def save_display_settings(self):
         self.settings.setValue('display/window_size', self.window_size.currentText())
         self.settings.setValue('display/play_speed', self.play_speed.currentText())
         self.settings.setValue('display/auto_window', self.auto_window.isChecked())
         self.settings.setValue('display/window_width', self.window_width.value())
         self.settings.setValue('display/window_center', self.window_center.value())
-        
-        # Save Processing settings
-        self.settings.setValue('processing/fat_threshold', self.fat_threshold.value())
-        self.settings.setValue('processing/noise_reduction', self.noise_reduction.currentText())
 
         # Save contrast and brightness settings
         self.settings.setValue('display/contrast', self.contrast_slider.value())
         self.settings.setValue('display/brightness', self.brightness_slider.value())
-       
-        
-        # Save Export settings
+
+    def save_processing_settings(self):
+        self.settings.setValue('processing/fat_threshold', self.fat_threshold.value())
+        self.settings.setValue('processing/noise_reduction', self.noise_reduction.currentText())
+        self.settings.setValue('processing/registration', self.registration.isChecked())
+        self.settings.setValue('processing/bias_correction', self.bias_correction.isChecked())
+        self.settings.setValue('processing/swap_correction', self.swap_correction.isChecked())
+
+    def save_export_settings(self):
         self.settings.setValue('export/format', self.export_format.currentText())
         self.settings.setValue('export/compression', self.compression.isChecked())
+        self.settings.setValue('export/dicom_compression', self.dicom_compression.currentText())
         self.settings.setValue('export/gif_duration', self.gif_duration.value())
         self.settings.setValue('export/gif_loop', self.gif_loop.isChecked())
 
@@ -352,9 +2167,57 @@ class MainWindow(QMainWindow):
         self.current_index = 0
         self.scan_folders = []
         self.play_timer = QTimer()
-        self.play_timer.timeout.connect(self.next_scan)
+        self.play_timer.setTimerType(Qt.PreciseTimer)
+        self.play_timer.timeout.connect(self.present_next_frame)
         self.is_playing = False
 
+        # Playback ring buffer: frames prepared ahead by worker threads and
+        # presented on a fixed schedule, frames that miss their slot are dropped
+        self.playback_buffer = deque()
+        self.playback_executor = None
+        self.playback_capacity = 8
+        self.playback_interval = 0.5
+        self.playback_settings = None
+        self.playback_start = 0.0
+        self.playback_next_index = 0
+        self.playback_next_slot = 0
+        self.playback_shown = 0
+        self.playback_dropped = 0
+
+        # Pixel reader shared by the viewer, mapping uncompressed slices from disk,
+        # and the writer used for DICOM export
+        self.pixel_reader = DicomPixelReader()
+        self.dicom_writer = DicomWriter()
+        self.processor = DixonProcessor()
+
+        # Per-slice display pyramid: 8-bit planes at full resolution plus the
+        # downsampled levels for each window size, least recently used first
+        self.display_cache = OrderedDict()
+        self.display_cache_bytes = 0
+        self.display_cache_limit = 256 * 1024 * 1024
+        self.display_cache_lock = threading.Lock()
+
+        # Float planes of recently processed slices and 8-bit tiles of zoomed views
+        self.plane_cache = OrderedDict()
+        self.plane_cache_limit = 8
+        self.tile_cache = OrderedDict()
+        self.tile_cache_limit = 1024
+        self.tile_size = 128
+
+        # Stacked (N, H, W) series volumes backing reformats, and the view plane
+        # state: reformats are built from the series of the axial slice last shown
+        self.volume_cache = OrderedDict()
+        self.volume_cache_limit = 2
+        # Series key and ordered members per in-phase file, from the DICOM headers
+        self.series_members = {}
+        self.view_plane = 'Axial'
+        self.axial_index = 0
+        self.reformat_params = None
+
+        # Zoom/pan shared by all four panels, the center is in image fractions
+        self.zoom = 1.0
+        self.view_center = (0.5, 0.5)
+
     def create_toolbar(self):
         toolbar = QWidget()
         toolbar_layout = QHBoxLayout(toolbar)
@@ -405,6 +2268,13 @@ class MainWindow(QMainWindow):
         self.play_button = QPushButton("▶ Play")
         self.play_button.setToolTip("Play/Pause animation")
         self.play_button.clicked.connect(self.toggle_play)
+
+        # View plane selector for reformatted views of the current series
+        self.plane_combo = QComboBox()
+        self.plane_combo.addItems(["Axial", "Coronal", "Sagittal"])
+        self.plane_combo.setToolTip("Browse axial slices or coronal/sagittal reformats of the current series")
+        self.plane_combo.setFont(QFont("Arial", 10))
+        self.plane_combo.currentTextChanged.connect(self.set_view_plane)
         
         buttons = [self.prev_button, self.load_button, self.next_button, 
                   self.play_button, self.reset_button, self.settings_button, 
@@ -413,6 +2283,7 @@ class MainWindow(QMainWindow):
         for button in buttons:
             button.setFont(QFont("Arial", 10))
             toolbar_layout.addWidget(button)
+        toolbar_layout.addWidget(self.plane_combo)
 
         toolbar_layout.addStretch()
 
@@ -438,6 +2309,9 @@ class MainWindow(QMainWindow):
         
         for position, title in zip(positions, titles):
             frame = ImageFrame(title)
+            frame.zoom_requested.connect(self.zoom_view)
+            frame.pan_requested.connect(self.pan_view)
+            frame.zoom_reset_requested.connect(self.reset_zoom)
             self.images_layout.addWidget(frame, *position)
             self.image_frames.append(frame)
 
@@ -450,63 +2324,26 @@ class MainWindow(QMainWindow):
             self.update_display()  # Refresh display with new settings
 
     def update_display(self):
-        if not self.scan_folders or self.current_index >= len(self.scan_folders):
+        if not self.scan_folders or self.current_index >= self.slice_count():
             return
 
         settings = QSettings('MRIViewer', 'DixonProcessor')
-        current_scan = self.scan_folders[self.current_index]
-        
-        try:
-            # Load DICOM images - keep in native scale
-            in_phase_dcm = pydicom.dcmread(current_scan['in_phase'])
-            out_phase_dcm = pydicom.dcmread(current_scan['out_phase'])
-            
-            in_phase_float32 = in_phase_dcm.pixel_array.astype(np.float32)
-            out_phase_float32 = out_phase_dcm.pixel_array.astype(np.float32)
 
-            # Get processing settings
-            fat_threshold = settings.value('processing/fat_threshold', 0.01, type=float)
-            noise_reduction = settings.value('processing/noise_reduction', 'None')
-            
-            # Get contrast and brightness settings
-            contrast = settings.value('display/contrast', 0, type=int) / 50.0  # Convert to range [-1, 1]
-            brightness = settings.value('display/brightness', 0, type=int) / 50.0  # Convert to range [-1, 1]
-            
-            # Keep preprocessing in native scale
-            in_phase_preprocessed = self.preprocess_image(in_phase_float32, noise_reduction, keep_scale=True)
-            out_phase_preprocessed = self.preprocess_image(out_phase_float32, noise_reduction, keep_scale=True)
-
-            # Normalize for Dixon processing while maintaining scale
-            in_phase_norm = self.normalize_image(in_phase_preprocessed)
-            out_phase_norm = self.normalize_image(out_phase_preprocessed)
-
-            # Perform fat-water separation in native scale
-            water, fat = self.perform_fat_water_separation(
-                in_phase_norm, 
-                out_phase_norm, 
-                fat_threshold=fat_threshold,
-            )
-
-            # Apply contrast and brightness adjustments to normalized images
-            adjusted_images = []
-            for img in [in_phase_norm, out_phase_norm, water, fat]:
-                adjusted = self.apply_contrast_brightness(img, contrast, brightness)
-                adjusted_images.append(adjusted)
+        try:
+            params = self.get_processing_params(settings)
 
             # Get display settings
             window_size = settings.value('display/window_size', '400x400')
-            width, height = map(int, window_size.split('x'))
-            
-            # Convert to 8-bit for display
-            display_images = [self.to_8bit_for_display(img) for img in adjusted_images]
-            
+
+            # Fitted views come from the pyramid, zoomed views from the visible tiles
+            display_images = self.render_slice(self.current_index, params, window_size, self.get_view())
+
             # Display images
             for frame, img_array in zip(self.image_frames, display_images):
-                image = QImage(img_array.data, img_array.shape[1], img_array.shape[0], 
-                            img_array.shape[1], QImage.Format_Grayscale8)
-                pixmap = QPixmap.fromImage(image)
-                scaled_pixmap = pixmap.scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                frame.image_label.setPixmap(scaled_pixmap)
+                frame.image_label.setPixmap(QPixmap.fromImage(self.array_to_qimage(img_array)))
+
+            if params[-3] and self.view_plane == 'Axial':
+                self.check_swaps(self.current_index)
 
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Error processing images: {str(e)}")
@@ -514,86 +2351,535 @@ class MainWindow(QMainWindow):
                 frame.image_label.clear()
             frame.image_label.setText("Image loading error")
 
-    
-    def preprocess_image(self, image, noise_reduction='None', keep_scale=True):
-        """Preprocess image with optional noise reduction, maintaining original scale if requested"""
+    def get_processing_params(self, settings):
+        """Snapshot the settings that affect the rendered planes, used as the display cache key"""
+        return (
+            settings.value('processing/fat_threshold', 0.01, type=float),
+            settings.value('processing/noise_reduction', 'None'),
+            settings.value('processing/registration', False, type=bool),
+            settings.value('processing/bias_correction', False, type=bool),
+            settings.value('processing/swap_correction', False, type=bool)
+            and DixonProcessor.swap_detection_available(),
+            settings.value('display/contrast', 0, type=int) / 50.0,  # Convert to range [-1, 1]
+            settings.value('display/brightness', 0, type=int) / 50.0,  # Convert to range [-1, 1]
+        )
 
-        # Apply noise reduction if specified
-        if noise_reduction == 'Gaussian':
-            from scipy.ndimage import gaussian_filter
-            image = gaussian_filter(image, sigma=1)
-        elif noise_reduction == 'Median':
-            from scipy.ndimage import median_filter
-            image = median_filter(image, size=3)
-        elif noise_reduction == 'Bilateral':
-            from skimage.restoration import denoise_bilateral
-            image = denoise_bilateral(image)
-        
-        if not keep_scale:
-            # Only normalize to 0-255 if specifically requested
-            image = (image - np.min(image)) / (np.max(image) - np.min(image))
-            image = (image * 255).astype(np.uint8)
-        
-        return image
+    def process_scan(self, index, params):
+        """Load and separate one slice pair, returning the normalized in/out phase, water and fat planes"""
+        fat_threshold, noise_reduction, registration, bias_correction, swap_correction = params[:-2]
+        current_scan = self.scan_folders[index]
 
-    def normalize_image(self, image):
-        """Normalize the image to the range [0, 1] while preserving relative intensities"""
-        if not isinstance(image, np.ndarray):
-            raise ValueError("Input must be a numpy array")
-        if image.size == 0:
-            raise ValueError("Input array cannot be empty")
-        
-        image_min = np.min(image)
-        image_max = np.max(image)
-        
-        
-        if image_min == image_max:
-            raise ValueError("Input array cannot have all identical values")
-        
-        normalized_image = (image - image_min) / (image_max - image_min)
-        return normalized_image
+        # Load DICOM images - keep in native scale
+        in_phase_float32 = self.pixel_reader.read(current_scan['in_phase']).astype(np.float32)
+        out_phase_float32 = self.pixel_reader.read(current_scan['out_phase']).astype(np.float32)
 
-    def gamma_correction(self, image, gamma=0.8):
-        """Apply gamma correction to the image"""
-        if not isinstance(image, np.ndarray):
-            raise ValueError("Input must be a numpy array")
-        if image.size == 0:
-            raise ValueError("Input array cannot be empty")
-        
-        corrected_image = np.power(image, gamma)
-        return corrected_image
+        bias_field = swap_map = None
+        if bias_correction or swap_correction:
+            # Corrections are estimated once for the whole series, the slice takes its plane of them
+            series_key, members = self.get_series_members(index)
+            position = [i for _, i, _ in members].index(index)
+            bias_field, swaps = self.get_series_corrections(series_key, members, bias_correction, swap_correction)
+            if bias_field is not None:
+                bias_field = bias_field[position]
+            if swaps is not None:
+                swap_map = swaps[0][position]
 
-    def perform_fat_water_separation(self, in_phase, out_phase, fat_threshold=0.1, advanced_method=False):
-        """Perform fat-water separation using basic or advanced Dixon method"""
-        in_phase = in_phase.astype(np.float32)
-        out_phase = out_phase.astype(np.float32)
+        return self.processor.separate(in_phase_float32, out_phase_float32,
+                                       fat_threshold=fat_threshold, noise_reduction=noise_reduction,
+                                       registration=registration,
+                                       keys=[(file_key(current_scan['in_phase']), file_key(current_scan['out_phase']))],
+                                       bias_field=bias_field, swap_map=swap_map)
 
-        # Basic Dixon method with signal difference
-        # Calculate signal difference
-        diff = (in_phase - out_phase)
-        
-        # Calculate masks for fat predominant regions, water image is the mean image
-        mean_signal = (in_phase + out_phase) / 2.0
-        
-        # initialize fat images
-        fat = np.zeros_like(in_phase)
-        # Areas where in_phase > out_phase are fat-containing
-        fat_mask = (in_phase > out_phase) 
-        # Apply masks and enhance contrast
-        fat[fat_mask] = diff[fat_mask]
+    def get_series_corrections(self, series_key, members, bias_correction, swap_correction,
+                               in_phase=None, out_phase=None):
+        """
+        Return the bias field and the (swap map, suspicious slices) of a whole series,
+        None for corrections that are off. They are cached by the processor, the
+        series is only read when one of them is missing.
+        """
+        bias_field = self.processor.cached_bias_field(series_key) if bias_correction else None
+        swaps = self.processor.cached_swaps(series_key) if swap_correction else None
+        if (bias_correction and bias_field is None) or (swap_correction and swaps is None):
+            if in_phase is None:
+                in_phase = np.stack(self.pixel_reader.read_series(
+                    [self.scan_folders[i]['in_phase'] for _, i, _ in members])).astype(np.float32)
+            if bias_correction and bias_field is None:
+                bias_field = self.processor.estimate_bias_field(in_phase, key=series_key)
+            if swap_correction and swaps is None:
+                if out_phase is None:
+                    out_phase = np.stack(self.pixel_reader.read_series(
+                        [self.scan_folders[i]['out_phase'] for _, i, _ in members])).astype(np.float32)
+                swaps = self.processor.detect_swaps(in_phase, out_phase, key=series_key)
+        return bias_field, swaps
+
+    def stream_series_corrections(self, series_key, members, bias_correction, swap_correction):
+        """
+        Return corrections(position, in_phase) -> (bias field, swap map) for the slices of a series.
+
+        Corrections the processor has cached are sliced. Missing ones are estimated
+        from block-averaged slices, read one at a time, and only brought to full
+        resolution per slice, so no full-resolution volume is built.
+        """
+        bias_field = self.processor.cached_bias_field(series_key) if bias_correction else None
+        swaps = self.processor.cached_swaps(series_key) if swap_correction else None
+        rows, cols = members[0][2].Rows, members[0][2].Columns
+        bias_factor = self.processor.bias_factor(rows, cols)
+        swap_factor = self.processor.swap_factor(rows, cols)
+
+        low_field = low_swap = reference = None
+        if (bias_correction and bias_field is None) or (swap_correction and swaps is None):
+            bias_low, swap_low, borders = [], [], []
+            for _, i, _ in members:
+                in_phase = self.pixel_reader.read(self.scan_folders[i]['in_phase']).astype(np.float32)[np.newaxis]
+                if bias_correction and bias_field is None:
+                    bias_low.append(self.processor.downsample(in_phase, bias_factor)[0])
+                if swap_correction and swaps is None:
+                    out_phase = self.pixel_reader.read(self.scan_folders[i]['out_phase']).astype(np.float32)
+                    low, border = self.processor.swap_features(in_phase, out_phase[np.newaxis], swap_factor)
+                    swap_low.append(low[0])
+                    borders.append(border[0])
+                QApplication.processEvents()
+            if bias_low:
+                low_field = self.processor.low_bias_field(np.stack(bias_low))
+            if swap_low:
+                low_swap, reference, _ = self.processor.decide_swaps(
+                    np.stack(swap_low), np.stack(borders), self.processor.series_groups(None, len(members)))
+
+        def corrections(position, in_phase):
+            field = swap_map = None
+            if bias_field is not None:
+                field = bias_field[position]
+            elif low_field is not None:
+                field = self.processor.upsample_bias_field(low_field[position], rows, cols, bias_factor)
+            if swaps is not None:
+                swap_map = swaps[0][position]
+            elif low_swap is not None:
+                swap_map = self.processor.swap_map_slices(low_swap[position:position + 1],
+                                                          reference[position:position + 1],
+                                                          in_phase[np.newaxis], swap_factor)[0]
+            return field, swap_map
+        return corrections
+
+    def check_swaps(self, index):
+        """Warn in the status bar when a slice was flagged by the fat/water swap detection"""
+        series_key, members = self.get_series_members(index)
+        swaps = self.processor.cached_swaps(series_key)
+        if swaps is not None and [i for _, i, _ in members].index(index) in swaps[1]:
+            self.update_status("Possible fat/water swap in this slice, check the water and fat images")
+
+    def window_for_display(self, planes, params):
+        """Apply contrast and brightness to normalized planes and convert them to 8-bit"""
+        contrast, brightness = params[-2:]
+        return [self.to_8bit_for_display(self.apply_contrast_brightness(plane, contrast, brightness))
+                for plane in planes]
+
+    def get_scan_planes(self, index, params):
+        """Return the cached float planes of a slice, processing it on a cache miss"""
+        if self.view_plane != 'Axial':
+            return self.get_reformat_planes(index, params)[0]
+
+        scan = self.scan_folders[index]
+        key = (scan['in_phase'], scan['out_phase'], params[:-2])
+
+        with self.display_cache_lock:
+            planes = self.plane_cache.get(key)
+            if planes is not None:
+                self.plane_cache.move_to_end(key)
+                return planes
+
+            # Slices of an already stacked series are views into its volume
+            for volume in self.volume_cache.values():
+                if volume['params'] == params[:-2] and index in volume['positions']:
+                    position = volume['positions'][index]
+                    return [stack[position] for stack in volume['planes']]
+
+        planes = self.process_scan(index, params)
+        with self.display_cache_lock:
+            self.plane_cache[key] = planes
+            while len(self.plane_cache) > self.plane_cache_limit:
+                self.plane_cache.popitem(last=False)
+        return planes
+
+    def get_plane_aspect(self, index, params):
+        """Physical height/width ratio of one displayed pixel, 1 for axial slices"""
+        if self.view_plane == 'Axial':
+            return 1.0
+        return self.get_reformat_planes(index, params)[1]
+
+    def slice_key(self, index):
+        """Hashable identity of the displayed slice, used in the display and tile cache keys"""
+        if self.view_plane == 'Axial':
+            scan = self.scan_folders[index]
+            return (scan['in_phase'], scan['out_phase'])
+        return (self.view_plane, self.axial_index, index)
+
+    def slice_count(self):
+        """Number of slices that can be browsed in the current view plane"""
+        if self.view_plane == 'Axial' or not self.scan_folders:
+            return len(self.scan_folders)
+        rows, cols = self.get_series_volume(self.axial_index, self.reformat_params)['planes'][0].shape[1:]
+        return rows if self.view_plane == 'Coronal' else cols
+
+    def get_series_volume(self, index, params):
+        """
+        Stack the series containing a slice into (N, H, W) volumes.
+
+        Slices from the same folder and series are ordered along the slice normal,
+        and water/fat are separated for the whole stack in one vectorized pass.
+        Reformatted planes and axial slices of the series are views into it.
+        """
+        with self.display_cache_lock:
+            for key, volume in self.volume_cache.items():
+                if volume['params'] == params[:-2] and index in volume['positions']:
+                    self.volume_cache.move_to_end(key)
+                    return volume
+
+        fat_threshold, noise_reduction, registration, bias_correction, swap_correction = params[:-2]
+        series_key, members = self.get_series_members(index)
+
+        # Slices are copied from their mapped files straight into the float stacks
+        shape = (len(members), members[0][2].Rows, members[0][2].Columns)
+        in_phase = np.empty(shape, dtype=np.float32)
+        out_phase = np.empty(shape, dtype=np.float32)
+        in_pixels = self.pixel_reader.read_series([self.scan_folders[i]['in_phase'] for _, i, _ in members])
+        out_pixels = self.pixel_reader.read_series([self.scan_folders[i]['out_phase'] for _, i, _ in members])
+        for position in range(len(members)):
+            in_phase[position] = in_pixels[position]
+            out_phase[position] = out_pixels[position]
+
+        bias_field, swaps = self.get_series_corrections(series_key, members, bias_correction, swap_correction,
+                                                        in_phase, out_phase)
+
+        planes = self.processor.separate(in_phase, out_phase,
+                                         fat_threshold=fat_threshold, noise_reduction=noise_reduction,
+                                         registration=registration,
+                                         keys=[(file_key(self.scan_folders[i]['in_phase']),
+                                                file_key(self.scan_folders[i]['out_phase'])) for _, i, _ in members],
+                                         bias_field=bias_field, swap_map=swaps[0] if swaps is not None else None)
+
+        # Spacing as (between slices, between rows, between columns)
+        header = members[0][2]
+        row_spacing, col_spacing = [float(v) for v in header.get('PixelSpacing', [1.0, 1.0])]
+        positions = [member[0] for member in members]
+        if len(members) > 1 and 'ImagePositionPatient' in header:
+            slice_spacing = float(np.median(np.abs(np.diff(positions)))) or 1.0
+        else:
+            slice_spacing = float(header.get('SpacingBetweenSlices', header.get('SliceThickness', 1.0)))
+
+        volume = {
+            'params': params[:-2],
+            'indices': [i for _, i, _ in members],
+            'positions': {i: position for position, (_, i, _) in enumerate(members)},
+            'planes': planes,
+            'spacing': (slice_spacing, row_spacing, col_spacing),
+        }
+        with self.display_cache_lock:
+            self.volume_cache[series_key + (params[:-2],)] = volume
+            while len(self.volume_cache) > self.volume_cache_limit:
+                self.volume_cache.popitem(last=False)
+        return volume
+
+    def get_series_members(self, index):
+        """
+        Return the (folder, SeriesInstanceUID) key of a slice's series and its
+        members as (position, index, header), ordered along the slice normal.
+        """
+        scan = self.scan_folders[index]
+        cached = self.series_members.get(scan['in_phase'])
+        if cached is not None:
+            return cached
+
+        series_uid = pydicom.dcmread(scan['in_phase'], stop_before_pixels=True).get('SeriesInstanceUID')
+        members = []
+        for i, candidate in enumerate(self.scan_folders):
+            if candidate['path'] != scan['path']:
+                continue
+            header = pydicom.dcmread(candidate['in_phase'], stop_before_pixels=True)
+            if header.get('SeriesInstanceUID') != series_uid:
+                continue
+            members.append((self.slice_position(header, i), i, header))
+        members.sort(key=lambda member: member[0])
+
+        series = ((scan['path'], series_uid), members)
+        for _, i, _ in members:
+            self.series_members[self.scan_folders[i]['in_phase']] = series
+        return series
+
+    def slice_position(self, header, fallback):
+        """Position of a slice along its normal, falling back to the instance number or scan order"""
+        if 'ImagePositionPatient' in header and 'ImageOrientationPatient' in header:
+            orientation = np.array(header.ImageOrientationPatient, dtype=np.float64)
+            normal = np.cross(orientation[:3], orientation[3:])
+            return float(np.dot(normal, np.array(header.ImagePositionPatient, dtype=np.float64)))
+        if 'InstanceNumber' in header:
+            return float(header.InstanceNumber)
+        return float(fallback)
+
+    def get_reformat_planes(self, index, params):
+        """
+        Return coronal or sagittal planes of the current series as strided views.
+
+        Slices are flipped so the last slice along the normal is at the top,
+        and the physical aspect ratio of a displayed pixel is returned with them.
+        """
+        volume = self.get_series_volume(self.axial_index, params)
+        slice_spacing, row_spacing, col_spacing = volume['spacing']
+        if self.view_plane == 'Coronal':
+            return [stack[::-1, index, :] for stack in volume['planes']], slice_spacing / col_spacing
+        return [stack[::-1, :, index] for stack in volume['planes']], slice_spacing / row_spacing
+
+    def set_view_plane(self, plane):
+        """Switch between axial slices and coronal/sagittal reformats of the current series"""
+        if plane == self.view_plane or not self.scan_folders:
+            self.view_plane = plane
+            return
+        if self.is_playing:
+            self.stop_playback()
+
+        settings = QSettings('MRIViewer', 'DixonProcessor')
+        if self.view_plane == 'Axial':
+            self.axial_index = self.current_index
+
+        try:
+            if plane != 'Axial':
+                self.reformat_params = self.get_processing_params(settings)
+                self.get_series_volume(self.axial_index, self.reformat_params)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Error building volume: {str(e)}")
+            self.plane_combo.setCurrentText(self.view_plane)
+            return
+
+        self.view_plane = plane
+        self.zoom = 1.0
+        self.view_center = (0.5, 0.5)
+        if plane == 'Axial':
+            self.current_index = self.axial_index
+        else:
+            self.current_index = self.slice_count() // 2
+        self.update_display()
+
+    def render_slice(self, index, params, window_size, view=None):
+        """Render the four 8-bit planes of a slice for the window size and zoom/pan view"""
+        if view is None or view[0] <= 1.0:
+            return self.get_display_level(index, params, window_size)
+        return self.render_viewport(index, params, window_size, view)
+
+    def get_display_level(self, index, params, window_size):
+        """
+        Return the four 8-bit planes of a slice already scaled for the given window size.
+
+        Each cache entry holds the full resolution planes of a slice and the levels
+        built from them so far, so playback and navigation over visited slices
+        only pick a precomputed level instead of reprocessing and rescaling.
+        """
+        key = (self.slice_key(index), params)
+
+        # Playback workers share the cache, slices are processed outside the lock
+        with self.display_cache_lock:
+            entry = self.display_cache.get(key)
+        if entry is None:
+            entry = {'full': self.window_for_display(self.get_scan_planes(index, params), params),
+                     'levels': {}}
+            with self.display_cache_lock:
+                if key in self.display_cache:
+                    entry = self.display_cache[key]
+                else:
+                    self.display_cache[key] = entry
+                    self.display_cache_bytes += sum(plane.nbytes for plane in entry['full'])
+
+        level = entry['levels'].get(window_size)
+        if level is None:
+            width, height = map(int, window_size.split('x'))
+            aspect = self.get_plane_aspect(index, params)
+            level = [self.resize_for_display(plane, width, height, aspect) for plane in entry['full']]
+
+        with self.display_cache_lock:
+            if key in self.display_cache:
+                self.display_cache.move_to_end(key)
+                if window_size not in entry['levels']:
+                    entry['levels'][window_size] = level
+                    self.display_cache_bytes += sum(plane.nbytes for plane in level)
+
+            # Evict least recently used slices, always keeping the current one
+            while self.display_cache_bytes > self.display_cache_limit and len(self.display_cache) > 1:
+                _, evicted = self.display_cache.popitem(last=False)
+                self.display_cache_bytes -= sum(plane.nbytes for plane in evicted['full'])
+                for evicted_level in evicted['levels'].values():
+                    self.display_cache_bytes -= sum(plane.nbytes for plane in evicted_level)
+
+        return level
+
+    def render_viewport(self, index, params, window_size, view):
+        """
+        Render only the visible part of a zoomed slice.
+
+        The source plane is split into fixed size tiles, only tiles overlapping
+        the viewport are windowed and converted to 8-bit, and they are cached so
+        panning reuses them. The assembled region is then resampled to the
+        window size with the exact subpixel crop of the view.
+        """
+        zoom, center_x, center_y = view
+        width, height = map(int, window_size.split('x'))
+        planes = self.get_scan_planes(index, params)
+        aspect = self.get_plane_aspect(index, params)
+        rows, cols = planes[0].shape
+        slice_key = self.slice_key(index)
+        tile = self.tile_size
+
+        # Visible source rectangle, kept inside the image
+        scale = min(width / cols, height / (rows * aspect)) * zoom
+        view_w = min(cols, width / scale)
+        view_h = min(rows, height / (scale * aspect))
+        x0 = min(max(center_x * cols - view_w / 2, 0), cols - view_w)
+        y0 = min(max(center_y * rows - view_h / 2, 0), rows - view_h)
+        x1, y1 = x0 + view_w, y0 + view_h
+
+        tile_x0, tile_x1 = int(x0) // tile, (int(np.ceil(x1)) - 1) // tile
+        tile_y0, tile_y1 = int(y0) // tile, (int(np.ceil(y1)) - 1) // tile
+        origin_x, origin_y = tile_x0 * tile, tile_y0 * tile
+        region_w = min(cols, (tile_x1 + 1) * tile) - origin_x
+        region_h = min(rows, (tile_y1 + 1) * tile) - origin_y
+
+        output_size = (max(1, int(round(view_w * scale))), max(1, int(round(view_h * scale * aspect))))
+        box = (x0 - origin_x, y0 - origin_y, x1 - origin_x, y1 - origin_y)
+
+        rendered = []
+        for panel, plane in enumerate(planes):
+            region = np.empty((region_h, region_w), dtype=np.uint8)
+            for tile_y in range(tile_y0, tile_y1 + 1):
+                for tile_x in range(tile_x0, tile_x1 + 1):
+                    key = (slice_key, params, panel, tile_y, tile_x)
+                    with self.display_cache_lock:
+                        tile_image = self.tile_cache.get(key)
+                        if tile_image is not None:
+                            self.tile_cache.move_to_end(key)
+                    if tile_image is None:
+                        ys = slice(tile_y * tile, min(rows, (tile_y + 1) * tile))
+                        xs = slice(tile_x * tile, min(cols, (tile_x + 1) * tile))
+                        tile_image = self.window_for_display([plane[ys, xs]], params)[0]
+                        with self.display_cache_lock:
+                            self.tile_cache[key] = tile_image
+                            while len(self.tile_cache) > self.tile_cache_limit:
+                                self.tile_cache.popitem(last=False)
+
+                    top, left = tile_y * tile - origin_y, tile_x * tile - origin_x
+                    region[top:top + tile_image.shape[0], left:left + tile_image.shape[1]] = tile_image
+
+            resized = Image.fromarray(region).resize(output_size, Image.BILINEAR, box=box)
+            rendered.append(np.ascontiguousarray(np.asarray(resized, dtype=np.uint8)))
+
+        return rendered
+
+    def resize_for_display(self, plane, width, height, aspect=1.0):
+        """Resample an 8-bit plane to fit inside width x height, keeping its physical aspect ratio"""
+        rows, cols = plane.shape
+        scale = min(width / cols, height / (rows * aspect))
+        size = (max(1, int(round(cols * scale))), max(1, int(round(rows * scale * aspect))))
+        if size == (cols, rows):
+            return plane
+        resized = Image.fromarray(plane).resize(size, Image.LANCZOS)
+        return np.ascontiguousarray(np.asarray(resized, dtype=np.uint8))
+
+    def clear_display_cache(self):
+        with self.display_cache_lock:
+            self.display_cache.clear()
+            self.display_cache_bytes = 0
+            self.plane_cache.clear()
+            self.tile_cache.clear()
+            self.volume_cache.clear()
+            self.series_members.clear()
+
+    def get_view(self):
+        """Current zoom/pan state shared by all four panels, as (zoom, center_x, center_y)"""
+        return (self.zoom, self.view_center[0], self.view_center[1])
+
+    def zoom_view(self, steps):
+        """Zoom all panels in or out around the current view center"""
+        self.zoom = min(max(self.zoom * (1.25 ** steps), 1.0), 16.0)
+        if self.zoom == 1.0:
+            self.view_center = (0.5, 0.5)
+        self.view_changed()
+
+    def pan_view(self, dx, dy):
+        """Pan all panels by a mouse drag of dx, dy screen pixels"""
+        if self.zoom <= 1.0:
+            return
+        pixmap = self.image_frames[0].image_label.pixmap()
+        if pixmap is None or pixmap.isNull():
+            return
+
+        # The displayed pixmap covers 1/zoom of the image in each direction
+        # (less at the image edges, where the view is clamped)
+        settings = QSettings('MRIViewer', 'DixonProcessor')
+        width, height = map(int, settings.value('display/window_size', '400x400').split('x'))
+        params = self.get_processing_params(settings)
+        planes = self.get_scan_planes(self.current_index, params)
+        aspect = self.get_plane_aspect(self.current_index, params)
+        rows, cols = planes[0].shape
+        extent_x = min(width / cols, height / (rows * aspect)) * self.zoom * cols
+        extent_y = extent_x / cols * rows * aspect
+
+        # Keep the center where the view is not clamped, so dragging back responds at once
+        half_x = min(1.0, width / extent_x) / 2
+        half_y = min(1.0, height / extent_y) / 2
+        center_x = min(max(self.view_center[0] - dx / extent_x, half_x), 1.0 - half_x)
+        center_y = min(max(self.view_center[1] - dy / extent_y, half_y), 1.0 - half_y)
+        self.view_center = (center_x, center_y)
+        self.view_changed()
+
+    def reset_zoom(self):
+        self.zoom = 1.0
+        self.view_center = (0.5, 0.5)
+        self.view_changed()
+
+    def view_changed(self):
+        if self.is_playing:
+            # Frames already queued were rendered for the previous view
+            self.restart_playback_buffer()
+        self.update_display()
+
+    def array_to_qimage(self, array):
+        """
+        Wrap a 2D 8-bit array in a grayscale QImage without copying the pixels.
+
+        The row stride is taken from the array itself, and the array is kept
+        referenced by the image so the buffer outlives any caller's variable.
+        """
+        if array.ndim != 2:
+            raise ValueError("Input must be a 2D array")
+        if array.dtype != np.uint8:
+            array = array.astype(np.uint8)
+        if array.strides[1] != 1 or array.strides[0] < array.shape[1]:
+            array = np.ascontiguousarray(array)
+
+        image = QImage(array.data, array.shape[1], array.shape[0],
+                       array.strides[0], QImage.Format_Grayscale8)
+        image.ndarray = array
+        return image
+
+    def qimage_to_array(self, image):
+        """
+        View the pixels of a QImage as a numpy array without copying.
+
+        Grayscale images give (height, width) arrays, 32-bit images give
+        (height, width, 4), any padding at the end of each row is sliced off.
+        The view is only valid while the image is alive, images in other
+        formats are converted first and returned as a copy.
+        """
+        if image.format() not in (QImage.Format_Grayscale8, QImage.Format_RGB32,
+                                  QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied):
+            return self.qimage_to_array(image.convertToFormat(QImage.Format_ARGB32)).copy()
+
+        height, width = image.height(), image.width()
+        channels = image.depth() // 8
+        ptr = image.constBits()
+        ptr.setsize(image.bytesPerLine() * height)
+        rows = np.frombuffer(ptr, np.uint8).reshape((height, image.bytesPerLine()))
+        array = rows[:, :width * channels]
+        if channels > 1:
+            array = array.reshape((height, width, channels))
+        return array
 
-        # Applying Dixon Equation
-        water = mean_signal
-        
-        # Normalize while keeping relative intensities
-        water = self.normalize_image(water)
-        fat = self.normalize_image(fat)
-        
-        
-        # Apply threshold to fat image, no need for a threshold on water because there is no subtraction
-        fat[fat < fat_threshold] = 0
-        
-        return water, fat
 
     def to_8bit_for_display(self, image):
         """Convert any scale image to 8-bit for display purposes only"""
@@ -611,6 +2897,8 @@ class MainWindow(QMainWindow):
     def load_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Folder")
         if folder:
+            if self.is_playing:
+                self.stop_playback()
             self.current_folder = folder
             self.update_status(f"Loading folder: {folder}")
             
@@ -619,6 +2907,9 @@ class MainWindow(QMainWindow):
                 self.progress_bar.setRange(0, 0)  # Indeterminate progress
                 
                 self.scan_folders = self.get_scan_folders(folder)
+                self.clear_display_cache()
+                self.view_plane = 'Axial'
+                self.plane_combo.setCurrentText('Axial')
                 
                 self.progress_bar.hide()
                 
@@ -672,7 +2963,7 @@ class MainWindow(QMainWindow):
             self.update_display()
 
     def next_scan(self):
-        if self.current_index < len(self.scan_folders) - 1:
+        if self.current_index < self.slice_count() - 1:
             self.current_index += 1
             self.update_display()
         elif self.is_playing:  # If playing and reached the end
@@ -685,9 +2976,7 @@ class MainWindow(QMainWindow):
         print("Toggling play")
         print(f"Current playing status: {self.is_playing}")
         if self.is_playing:
-            self.play_timer.stop()
-            self.play_button.setText("▶ Play")
-            self.is_playing = False
+            self.stop_playback()
         else:
             # Get the speed multiplier from the play_speed combo box
             settings = QSettings('MRIViewer', 'DixonProcessor')
@@ -699,11 +2988,107 @@ class MainWindow(QMainWindow):
             
             # Calculate the actual interval based on the speed multiplier
             interval = int(base_interval / speed_multiplier)
-            
-            self.play_timer.start(interval)
+
+            # Frames are prepared with the settings active when playback starts
+            params = self.get_processing_params(settings)
+            window_size = settings.value('display/window_size', '400x400')
+
+            self.playback_interval = interval / 1000.0
+            self.playback_settings = (params, window_size)
+            self.playback_executor = ThreadPoolExecutor(max_workers=2)
+            self.playback_buffer.clear()
+            # Slot 0 is the slice already on screen, playback continues from the next one
+            self.playback_next_index = (self.current_index + 1) % self.slice_count()
+            self.playback_next_slot = 1
+            self.playback_shown = 0
+            self.playback_dropped = 0
+            self.fill_playback_buffer()
+
+            # Tick at twice the frame rate so every slot is seen close to its start
+            self.playback_start = time.perf_counter()
+            self.play_timer.start(max(1, interval // 2))
             self.play_button.setText("⏸ Pause")
             self.is_playing = True
 
+    def stop_playback(self):
+        self.play_timer.stop()
+        self.play_button.setText("▶ Play")
+        self.is_playing = False
+
+        if self.playback_executor is not None:
+            for _, _, future in self.playback_buffer:
+                future.cancel()
+            self.playback_executor.shutdown(wait=False)
+            self.playback_executor = None
+        self.playback_buffer.clear()
+
+        if self.playback_shown or self.playback_dropped:
+            self.update_status(f"Playback: {self.playback_shown} frames shown, "
+                               f"{self.playback_dropped} dropped")
+
+    def fill_playback_buffer(self):
+        """Queue upcoming slices on the playback workers until the ring buffer is full"""
+        params, window_size = self.playback_settings
+        view = self.get_view()
+        slice_count = self.slice_count()
+        while len(self.playback_buffer) < self.playback_capacity:
+            index = self.playback_next_index
+            future = self.playback_executor.submit(
+                self.prepare_playback_frame, index, params, window_size, view)
+            self.playback_buffer.append((self.playback_next_slot, index, future))
+            self.playback_next_index = (index + 1) % slice_count
+            self.playback_next_slot += 1
+
+    def restart_playback_buffer(self):
+        """Discard queued frames and refill from the slice after the current one"""
+        if not self.playback_buffer:
+            return
+        for _, _, future in self.playback_buffer:
+            future.cancel()
+        self.playback_next_slot = self.playback_buffer[0][0]
+        self.playback_next_index = (self.current_index + 1) % self.slice_count()
+        self.playback_buffer.clear()
+        self.fill_playback_buffer()
+
+    def prepare_playback_frame(self, index, params, window_size, view):
+        """Build the four ready-to-show images of a slice, runs on a playback worker"""
+        return [self.array_to_qimage(plane)
+                for plane in self.render_slice(index, params, window_size, view)]
+
+    def present_next_frame(self):
+        """
+        Show the frame scheduled for the current time slot.
+
+        Slots are derived from the elapsed time rather than counted ticks, so
+        timer jitter does not accumulate. Frames whose slot passed before they
+        were ready are dropped to keep the nominal frame rate.
+        """
+        if not self.playback_buffer:
+            return
+
+        slot = int((time.perf_counter() - self.playback_start) / self.playback_interval)
+
+        while self.playback_buffer and self.playback_buffer[0][0] < slot:
+            self.playback_buffer.popleft()
+            self.playback_dropped += 1
+
+        # An unready head frame stays queued, a later tick in its slot may still show it
+        if self.playback_buffer and self.playback_buffer[0][0] == slot and self.playback_buffer[0][2].done():
+            _, index, future = self.playback_buffer.popleft()
+            try:
+                images = future.result()
+            except Exception as e:
+                self.stop_playback()
+                QMessageBox.critical(self, "Error", f"Error processing images: {str(e)}")
+                return
+
+            self.current_index = index
+            for frame, image in zip(self.image_frames, images):
+                frame.image_label.setPixmap(QPixmap.fromImage(image))
+            self.playback_shown += 1
+
+        self.fill_playback_buffer()
+
     def export_images(self):
         if not self.scan_folders:
             QMessageBox.warning(self, "Warning", "No images to export!")
@@ -712,6 +3097,10 @@ class MainWindow(QMainWindow):
         settings = QSettings('MRIViewer', 'DixonProcessor')
         export_format = settings.value('export/format', 'DICOM')
         use_compression = settings.value('export/compression', True, type=bool)
+        dicom_compression = settings.value('export/dicom_compression', 'RLE Lossless') if use_compression else None
+        if dicom_compression is not None and dicom_compression not in DicomWriter.available_compressions():
+            # Saved while an encoder plugin was installed, RLE Lossless needs none
+            dicom_compression = 'RLE Lossless'
         
         export_dir = QFileDialog.getExistingDirectory(self, "Select Export Directory")
         if not export_dir:
@@ -720,11 +3109,15 @@ class MainWindow(QMainWindow):
         try:
             if export_format == 'GIF':
                 self._export_as_gif(export_dir)
+            elif export_format in VolumeWriter.FORMATS:
+                self._export_as_volume(export_dir, export_format, use_compression)
             else:
                 self.progress_bar.show()
                 self.progress_bar.setRange(0, 4)  # Four images to export
                 
                 frames = ['in_phase', 'out_phase', 'water', 'fat']
+                dicom_datasets = []
+                dicom_paths = []
                 for i, frame in enumerate(self.image_frames):
                     pixmap = frame.image_label.pixmap()
                     if pixmap:
@@ -733,12 +3126,12 @@ class MainWindow(QMainWindow):
                         filename = f"{frames[i]}_{self.current_index}"
                         if export_format == 'DICOM':
                             # Handle DICOM export with metadata
-                            file_meta = FileMetaDataset()
+                            file_meta = pydicom.dataset.FileMetaDataset()
                             file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
                             file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
                             file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
                             
-                            ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+                            ds = pydicom.dataset.FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
                             
                             # Required DICOM attributes
                             ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
@@ -757,11 +3150,9 @@ class MainWindow(QMainWindow):
                                         setattr(ds, elem.keyword, elem.value)
                             
                             # Convert image to array for DICOM
-                            buffer = image.bits().asstring(image.width() * image.height() * 4)
-                            arr = np.frombuffer(buffer, dtype=np.uint8).reshape(
-                                (image.height(), image.width(), 4)
-                            )
-                            arr = arr[:,:,0]  # Take first channel for grayscale
+                            arr = self.qimage_to_array(image)
+                            if arr.ndim > 2:
+                                arr = arr[:,:,0]  # Take first channel for grayscale
                             
                             ds.Rows = arr.shape[0]
                             ds.Columns = arr.shape[1]
@@ -773,9 +3164,9 @@ class MainWindow(QMainWindow):
                             ds.PixelRepresentation = 0
                             ds.PixelData = arr.tobytes()
                             
-                            # Save DICOM
-                            filepath = os.path.join(export_dir, f"{filename}.dcm")
-                            ds.save_as(filepath, write_like_original=False)
+                            # Saved together below, so compressed files are encoded in parallel
+                            dicom_datasets.append(ds)
+                            dicom_paths.append(os.path.join(export_dir, f"{filename}.dcm"))
                         else:
                             # Handle other image formats with compression
                             filepath = os.path.join(export_dir, f"{filename}.{export_format.lower()}")
@@ -796,6 +3187,9 @@ class MainWindow(QMainWindow):
                                 image.save(filepath)
                         
                         self.progress_bar.setValue(i + 1)
+
+                if dicom_datasets:
+                    self.dicom_writer.write_series(dicom_datasets, dicom_paths, dicom_compression)
                 
                 self.progress_bar.hide()
                 self.update_status("Images exported successfully")
@@ -804,6 +3198,56 @@ class MainWindow(QMainWindow):
             self.progress_bar.hide()
             QMessageBox.critical(self, "Error", f"Error exporting images: {str(e)}")
 
+    def _export_as_volume(self, export_dir, volume_format, compress):
+        """
+        Export the series of the current slice as in-phase, out-phase, water, fat
+        and fat fraction volumes, processing and writing one slice at a time.
+
+        All volumes keep the native intensity scale: the images are only divided
+        by the bias field, registered and swap corrected when those corrections
+        are on, and water and fat come from DixonProcessor.native_water_fat.
+        """
+        params = self.get_processing_params(QSettings('MRIViewer', 'DixonProcessor'))
+        _, _, registration, bias_correction, swap_correction = params[:-2]
+        index = self.current_index if self.view_plane == 'Axial' else self.axial_index
+        series_key, members = self.get_series_members(index)
+        headers = [header for _, _, header in members]
+        corrections = self.stream_series_corrections(series_key, members, bias_correction, swap_correction)
+
+        description = headers[0].get('SeriesDescription') or 'Dixon'
+        name = ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(description))
+        writer = VolumeWriter(os.path.join(export_dir, f"{name}_{headers[0].get('SeriesNumber', '')}".rstrip('_')),
+                              ['in_phase', 'out_phase', 'water', 'fat', 'fat_fraction'],
+                              (len(members), headers[0].Rows, headers[0].Columns),
+                              VolumeWriter.series_affine(headers), volume_format, compress)
+        self.progress_bar.show()
+        self.progress_bar.setRange(0, len(members))
+        try:
+            for position, (_, i, _) in enumerate(members):
+                scan = self.scan_folders[i]
+                in_phase = self.pixel_reader.read(scan['in_phase']).astype(np.float32)
+                out_phase = self.pixel_reader.read(scan['out_phase']).astype(np.float32)
+                bias_field, swap_map = corrections(position, in_phase)
+                if registration:
+                    keys = [(file_key(scan['in_phase']), file_key(scan['out_phase']))]
+                    out_phase = self.processor.align(in_phase[np.newaxis], out_phase[np.newaxis], keys)[0]
+                if bias_field is not None:
+                    in_phase, out_phase = in_phase / bias_field, out_phase / bias_field
+                water, fat = self.processor.native_water_fat(in_phase, out_phase, swap_map)
+                writer.write_slice({
+                    'in_phase': in_phase,
+                    'out_phase': out_phase,
+                    'water': water,
+                    'fat': fat,
+                    'fat_fraction': self.processor.fat_fraction(in_phase, out_phase, swap_map),
+                })
+                self.progress_bar.setValue(position + 1)
+                QApplication.processEvents()
+        finally:
+            writer.close()
+            self.progress_bar.hide()
+        self.update_status(f"Exported {len(members)} slices as {volume_format}")
+
     def _export_as_gif(self, export_dir):
         """Export four separate GIFs, one for each image type (In Phase, Out Phase, Water Only, Fat Only)"""
         from PIL import Image
@@ -815,7 +3259,7 @@ class MainWindow(QMainWindow):
         
         try:
             self.progress_bar.show()
-            total_frames = len(self.scan_folders) * len(self.image_frames)
+            total_frames = self.slice_count() * len(self.image_frames)
             self.progress_bar.setRange(0, total_frames)
             progress = 0
             
@@ -828,7 +3272,7 @@ class MainWindow(QMainWindow):
             }
             
             # Collect frames
-            for i in range(len(self.scan_folders)):
+            for i in range(self.slice_count()):
                 self.current_index = i
                 self.update_display()
                 
@@ -904,7 +3348,14 @@ class MainWindow(QMainWindow):
     def reset_view(self):
         # Reset view to default state
         if hasattr(self, 'current_index'):
-            self.update_display()
+            self.reset_zoom()
+
+    def closeEvent(self, event):
+        if self.is_playing:
+            self.stop_playback()
+        self.pixel_reader.close()
+        self.dicom_writer.close()
+        super().closeEvent(event)
 
     def update_status(self, message):
         self.status_bar.showMessage(message, 3000)  # Show for 3 seconds
@@ -925,9 +3376,7 @@ class MainWindow(QMainWindow):
         # Convert QImage to numpy array
         width = qimage.width()
         height = qimage.height()
-        ptr = qimage.bits()
-        ptr.setsize(height * width * 4)
-        arr = np.frombuffer(ptr, np.uint8).reshape((height, width, 4))
+        arr = self.qimage_to_array(qimage)
         
         # Convert to grayscale if needed
         if len(arr.shape) > 2:
@@ -949,7 +3398,75 @@ class MainWindow(QMainWindow):
         ds.save_as(filepath)
 
 def main():
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Advanced Dixon MRI Viewer")
+    parser.add_argument('--watch', metavar='DIR',
+                        help="process inphase/outphase series dropped into DIR without opening the viewer")
+    parser.add_argument('--output', metavar='DIR', help="where watch mode writes the water/fat series")
+    parser.add_argument('--serve', metavar='PORT', type=int, nargs='?', const=8765,
+                        help="run the local processing server on PORT (default: 8765) without opening the viewer")
+    parser.add_argument('--host', default='127.0.0.1', help="address the server listens on (default: 127.0.0.1)")
+    parser.add_argument('--allow-remote', action='store_true',
+                        help="let --host be a non-loopback address, exposing file reads and writes to the network")
+    parser.add_argument('--poll-interval', type=float, default=1.0, help="seconds between polls (default: 1)")
+    parser.add_argument('--settle-time', type=float, default=2.0,
+                        help="seconds a file must stay unchanged before it is processed (default: 2)")
+    parser.add_argument('--workers', type=int, default=2, help="concurrent processing jobs (default: 2)")
+    parser.add_argument('--compression', metavar='SCHEME',
+                        help="write compressed DICOM with this transfer syntax, one of "
+                             f"{', '.join(DicomWriter.COMPRESSIONS)} if pydicom can encode it")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="print how long the viewer took to start and which imports were deferred")
+    args, qt_args = parser.parse_known_args()
+    # Checked after parsing, listing the encoders would import pydicom before the viewer starts
+    if args.compression and args.compression not in DicomWriter.available_compressions():
+        parser.error(f"--compression: {args.compression!r} is not available, "
+                     f"choose from {', '.join(DicomWriter.available_compressions())}")
+
+    # Settings saved from the viewer, shared by the headless modes
+    settings = QSettings('MRIViewer', 'DixonProcessor')
+    swap_correction = settings.value('processing/swap_correction', False, type=bool)
+    if swap_correction and (args.serve is not None or args.watch) and not DixonProcessor.swap_detection_available():
+        print("Fat/water swap correction needs scipy, which is not installed, it is turned off", file=sys.stderr)
+        swap_correction = False
+
+    if args.serve is not None:
+        try:
+            server = SeparationServer(
+                args.host, args.serve,
+                fat_threshold=settings.value('processing/fat_threshold', 0.1, type=float),
+                noise_reduction=settings.value('processing/noise_reduction', 'None'),
+                registration=settings.value('processing/registration', False, type=bool),
+                bias_correction=settings.value('processing/bias_correction', False, type=bool),
+                swap_correction=swap_correction,
+                compression=args.compression,
+                allow_remote=args.allow_remote,
+            )
+        except ValueError as e:
+            parser.error(f"--host: {e}, pass --allow-remote to listen there anyway")
+        server.serve_forever()
+        return
+
+    if args.watch:
+        if not args.output:
+            parser.error("--watch requires --output")
+        # Use the processing settings saved from the viewer
+        WatchFolderIngest(
+            args.watch, args.output,
+            fat_threshold=settings.value('processing/fat_threshold', 0.1, type=float),
+            noise_reduction=settings.value('processing/noise_reduction', 'None'),
+            registration=settings.value('processing/registration', False, type=bool),
+            bias_correction=settings.value('processing/bias_correction', False, type=bool),
+            swap_correction=swap_correction,
+            compression=args.compression,
+            poll_interval=args.poll_interval,
+            settle_time=args.settle_time,
+            max_workers=args.workers,
+            max_pending=2 * args.workers,
+        ).run()
+        return
+
+    STARTUP.mark('imports')
+    app = QApplication(sys.argv[:1] + qt_args)
     
     # Set app icon for all windows
     icon_path = os.path.join(os.path.dirname(__file__), 'Icon\medical-viewer-icon.svg')
@@ -957,10 +3474,25 @@ def main():
         app.setWindowIcon(QIcon(icon_path))
     
     # Apply dark style
+    import qdarkstyle
     app.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
+    STARTUP.mark('application')
     
     window = MainWindow()
     window.show()
+    STARTUP.mark('main window')
+
+    def on_interactive():
+        elapsed = STARTUP.mark('first event')
+        if elapsed > STARTUP.BUDGET:
+            print(f"Startup took {elapsed:.2f} s, over the {STARTUP.BUDGET:.2f} s budget "
+                  f"(run with --startup-report for details)", file=sys.stderr)
+        # Load the processing libraries while the user is still choosing a folder
+        threading.Thread(target=warm_up_imports, args=(WARM_UP_MODULES, args.startup_report),
+                         name='warm-up', daemon=True).start()
+
+    # Fires once the event loop is running, i.e. when the window can take input
+    QTimer.singleShot(0, on_interactive)
     sys.exit(app.exec_())
 
 if __name__ == '__main__':